@@ -0,0 +1,252 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    from ckan.common import config
+except ImportError:  # for ckan <= 2.5
+    from pylons import config
+
+try:
+    from ckan.lib.redis import connect_to_redis
+except ImportError:  # for ckan < 2.7
+    connect_to_redis = None
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    '''
+    A thread-safe, process-local cache whose entries expire ``ttl`` seconds
+    after they were set. A ``ttl`` of 0 disables the cache.
+    '''
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Return the cached value for key, or None if it is missing or expired.
+        '''
+        if not self.ttl:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        if not self.ttl:
+            return
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class LRUCache(object):
+    '''
+    A thread-safe, process-local cache holding at most ``maxsize`` entries,
+    evicting the least recently used entry when full. A ``maxsize`` of 0
+    disables the cache.
+    '''
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Return the cached value for key, or None if it is missing.
+        '''
+        if not self.maxsize:
+            return None
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                # move it to the most recently used end
+                self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedTTLCache(object):
+    '''
+    A cache for JSON serializable values whose entries expire ``ttl`` seconds
+    after they were set. Entries are kept in CKAN's Redis (CKAN >= 2.7), so
+    they are shared by all worker processes. If Redis isn't available a
+    process-local TTLCache is used instead, as it is for ``retry_after``
+    seconds after Redis fails, so an outage costs one connection timeout
+    per ``retry_after`` seconds rather than one per lookup. A ``ttl`` of 0
+    disables the cache.
+    '''
+
+    # Seconds to use the local cache for after Redis fails, shared by all
+    # SharedTTLCaches in the process
+    retry_after = 30
+
+    _redis_down_until = 0
+    _redis_lock = threading.Lock()
+
+    def __init__(self, name, ttl=0):
+        self.name = name
+        self._local = TTLCache(ttl)
+
+    @property
+    def ttl(self):
+        return self._local.ttl
+
+    @ttl.setter
+    def ttl(self, value):
+        self._local.ttl = value
+
+    def _redis_key(self, key):
+        return 'ckanext-experience:{site_id}:{name}:{key}'.format(
+            site_id=config.get('ckan.site_id', ''), name=self.name,
+            key=key)
+
+    def _redis(self):
+        '''
+        Return a Redis connection, or None if Redis isn't available or
+        failed less than ``retry_after`` seconds ago.
+        '''
+        if connect_to_redis is None or \
+                SharedTTLCache._redis_down_until > time.time():
+            return None
+        try:
+            return connect_to_redis()
+        except Exception as e:
+            self._redis_failed(e)
+            return None
+
+    def _redis_failed(self, error):
+        '''
+        Stop using Redis for ``retry_after`` seconds. Only the first failure
+        of an outage is logged.
+        '''
+        with SharedTTLCache._redis_lock:
+            if not SharedTTLCache._redis_down_until:
+                log.warning('Could not reach the Redis cache, using the local '
+                            'cache instead: {0}'.format(error))
+            SharedTTLCache._redis_down_until = time.time() + self.retry_after
+
+    def _redis_succeeded(self):
+        if SharedTTLCache._redis_down_until:
+            with SharedTTLCache._redis_lock:
+                SharedTTLCache._redis_down_until = 0
+            log.info('Reached the Redis cache again')
+
+    def get(self, key):
+        '''
+        Return the cached value for key, or None if it is missing or expired.
+        '''
+        if not self.ttl:
+            return None
+        redis_conn = self._redis()
+        if redis_conn is not None:
+            try:
+                value = redis_conn.get(self._redis_key(key))
+            except Exception as e:
+                self._redis_failed(e)
+            else:
+                self._redis_succeeded()
+                return json.loads(value) if value is not None else None
+        return self._local.get(key)
+
+    def set(self, key, value):
+        if not self.ttl:
+            return
+        redis_conn = self._redis()
+        if redis_conn is not None:
+            try:
+                redis_conn.set(self._redis_key(key), json.dumps(value),
+                               ex=self.ttl)
+            except Exception as e:
+                self._redis_failed(e)
+            else:
+                self._redis_succeeded()
+                return
+        self._local.set(key, value)
+
+    def invalidate(self, key):
+        redis_conn = self._redis()
+        if redis_conn is not None:
+            try:
+                redis_conn.delete(self._redis_key(key))
+            except Exception as e:
+                self._redis_failed(e)
+            else:
+                self._redis_succeeded()
+        self._local.invalidate(key)
+
+    def clear(self):
+        redis_conn = self._redis()
+        if redis_conn is not None:
+            try:
+                for redis_key in redis_conn.scan_iter(self._redis_key('*')):
+                    redis_conn.delete(redis_key)
+            except Exception as e:
+                self._redis_failed(e)
+            else:
+                self._redis_succeeded()
+        self._local.clear()
+
+
+# Number of active, public datasets per experience id, shared by all worker
+# processes where Redis is available, so invalidating a count clears it for
+# all of them. Configured with `ckanext.experience.num_datasets_cache_ttl`.
+num_datasets = SharedTTLCache('num_datasets')
+
+# Rendered experience notes, keyed by a hash of the notes and the
+# experience's metadata_modified. Configured with
+# `ckanext.experience.notes_cache_size`.
+notes_formatted = LRUCache()
+
+# The home page site statistics. Configured with
+# `ckanext.experience.site_stats_cache_ttl`.
+site_stats = SharedTTLCache('site_stats')
@@ -15,15 +15,35 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import os
+import csv
+import itertools
+import multiprocessing
+from collections import Counter, OrderedDict
+
+from dateutil.parser import parse as parse_date
+
 from ckan import model
+import ckan.lib.search as search
 from ckan.lib.cli import CkanCommand
 from ckan.lib.munge import munge_title_to_name, substitute_ascii_equivalents
 from ckan.logic import get_action
 
+from ckanext.experience import cache as experience_cache
+from ckanext.experience import jobs
+from ckanext.experience.jobs import purge_deleted_experiences
+from ckanext.experience.model import (ExperiencePackageAssociation,
+                                      create_missing_indexes)
+
 
 import logging
 log = logging.getLogger(__name__)
 
+DEFAULT_CHECKPOINT_FILE = 'experience_migrate.checkpoint'
+
+# number of names looked up per query when checking for name collisions
+NAME_LOOKUP_CHUNK_SIZE = 500
+
 
 class MigrationCommand(CkanCommand):
     '''
@@ -37,6 +57,39 @@ class MigrationCommand(CkanCommand):
         paster experience migrate -c <path to config file> [--allow-duplicates]
             - Migrate Related Items to Experiences and allow duplicates
 
+        paster experience migrate -c <path to config file> [--batch-size N]
+                [--workers N] [--checkpoint <path to checkpoint file>]
+            - Migrate Related Items to Experiences in batches of N (default:
+              100) with N worker processes (default: 1). Each batch is
+              committed and recorded in the checkpoint file (default:
+              experience_migrate.checkpoint), so an interrupted migration
+              resumes after the last committed batch.
+
+        paster experience migrate -c <path to config file> [--report <path to csv file>]
+            - Also write the preflight report of duplicate titles and names
+              to a CSV file
+
+        paster experience create_indexes -c <path to config file>
+            - Create any missing indexes on the experience tables
+
+        paster experience purge_deleted -c <path to config file> [--batch-size N]
+            - Purge experiences that were soft deleted
+
+        paster experience backfill_image_urls -c <path to config file>
+            - Store the image display URL, and the URLs of the resized
+              copies of the image, of experiences saved without one, or
+              after ckan.site_url or ckan.root_path changed
+
+        paster experience reindex -c <path to config file> [--experiences-only]
+                [--experience <id or name>] [--since <timestamp>]
+                [--batch-size N] [--workers N]
+            - Rebuild the search index of experiences and the datasets in
+              them, of experiences only (--experiences-only), or of the
+              datasets in one experience (--experience). --since only
+              reindexes those modified since the ISO 8601 timestamp. Each
+              batch of N (default: 100) is committed to the search index,
+              with N worker processes (default: 1).
+
     Must be run from the ckanext-experience directory.
     '''
     summary = __doc__.split('\n')[0]
@@ -50,6 +103,33 @@ class MigrationCommand(CkanCommand):
                             related items with duplicate titles to be migrated.
                             Duplicate experiences will be created as
                             'duplicate_<related-name>_<related-id>'.''', action='store_true')
+        self.parser.add_option('--report', dest='report', default=None,
+                            help='''Write the Related Items with duplicate
+                            titles, or titles that make the same experience
+                            name, to this CSV file.''')
+        self.parser.add_option('--batch-size', dest='batch_size', type='int',
+                            default=100, help='''Number of related items to
+                            migrate, or experiences to purge, per
+                            transaction, or of datasets to reindex per search
+                            index commit.''')
+        self.parser.add_option('--workers', dest='workers', type='int',
+                            default=1, help='''Number of processes migrating
+                            related items, or reindexing datasets, in
+                            parallel.''')
+        self.parser.add_option('--experiences-only', dest='experiences_only',
+                            default=False, action='store_true',
+                            help='''Only reindex experiences, not the
+                            datasets in them.''')
+        self.parser.add_option('--experience', dest='experience',
+                            default=None, help='''Only reindex the datasets
+                            in this experience (id or name).''')
+        self.parser.add_option('--since', dest='since', default=None,
+                            help='''Only reindex experiences and datasets
+                            modified since this ISO 8601 timestamp.''')
+        self.parser.add_option('--checkpoint', dest='checkpoint',
+                            default=DEFAULT_CHECKPOINT_FILE, help='''File
+                            recording the migration's progress, so it can be
+                            resumed.''')
 
     def command(self):
         '''
@@ -64,25 +144,41 @@ class MigrationCommand(CkanCommand):
 
         if cmd == 'migrate':
             self.migrate()
-        elif cmd == 'make_related':
-            self.make_related()
+        elif cmd == 'create_indexes':
+            self.create_indexes()
+        elif cmd == 'purge_deleted':
+            self.purge_deleted()
+        elif cmd == 'backfill_image_urls':
+            self.backfill_image_urls()
+        elif cmd == 'reindex':
+            self.reindex()
         else:
             print('Command "{0}" not recognized'.format(cmd))
 
     def migrate(self):
         '''
-
+        Migrate Related Items to Experiences, a batch at a time.
         '''
         # determine whether migration should allow duplicates
         allow_duplicates = self.options.allow_duplicates
 
-        related_items = get_action('related_list')(data_dict={})
-
         # preflight:
-        # related items must have unique titles before migration
-        related_titles = [i['title'] for i in related_items]
+        # related items must have unique titles, and titles that make unique
+        # experience names, before migration
+        related_items = model.Session.query(model.Related.id,
+                                            model.Related.title).all()
+        related_titles = [title for (related_id, title) in related_items]
         # make a list of duplicate titles
         duplicate_titles = self._find_duplicates(related_titles)
+        # and of the names made by more than one (different) title
+        name_collisions = self._find_name_collisions(related_titles)
+
+        if self.options.report:
+            self._write_report(self.options.report, related_items,
+                               duplicate_titles, name_collisions)
+            print('Wrote the preflight report to {0}'.format(
+                self.options.report))
+
         if duplicate_titles and allow_duplicates == False:
             print(
                 """All Related Items must have unique titles before migration. The following
@@ -91,57 +187,183 @@ migration can continue. Please correct and try again:"""
             )
             for i in duplicate_titles:
                 print(i)
+        if name_collisions and allow_duplicates == False:
+            print(
+                """The following Related Item titles are different but make the same experience
+name, and need to be corrected before migration can continue. Please correct
+and try again:"""
+            )
+            for name, titles in name_collisions.items():
+                print('{0}: {1}'.format(name, ', '.join(titles)))
+        if (duplicate_titles or name_collisions) and allow_duplicates == False:
             return
 
-        for related in related_items:
-            existing_experience = get_action('package_search')(
-                data_dict={'fq': '+dataset_type:experience original_related_item_id:{0}'.format(related['id'])})
-            normalized_title = substitute_ascii_equivalents(related['title'])
-            if existing_experience['count'] > 0:
-                print('Experience for Related Item "{0}" already exists.'.format(
-                    normalized_title))
+        checkpoint_file = self.options.checkpoint
+        last_id = self._read_checkpoint(checkpoint_file)
+        if last_id:
+            print('Resuming migration after Related Item "{0}"'.format(last_id))
+
+        # the names already used by packages, loaded up front. Names are
+        # allocated as the batches are generated in this process, so names
+        # allocated earlier in the run count too, whatever the worker.
+        taken_names = _get_taken_names(
+            set(munge_title_to_name(title or '') for title in related_titles))
+
+        batches = _related_item_batches(last_id, self.options.batch_size,
+                                        _get_migrated_related_ids(),
+                                        taken_names)
+
+        pool = None
+        if self.options.workers > 1:
+            # don't let the worker processes share this process' database
+            # connections
+            model.Session.remove()
+            model.meta.engine.dispose()
+            pool = multiprocessing.Pool(self.options.workers)
+            # the results are returned in order, so the checkpoint only moves
+            # past a batch once every batch before it has been committed
+            results = _map_in_chunks(pool, _migrate_batch, batches,
+                                     self.options.workers * 2)
+        else:
+            results = itertools.imap(_migrate_batch, batches)
+
+        try:
+            for batch_last_id, messages in results:
+                for message in messages:
+                    print(message)
+                self._write_checkpoint(checkpoint_file, batch_last_id)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # the migration is complete, so there's nothing to resume
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+    def backfill_image_urls(self):
+        '''
+        Save each active experience with an image again, so its image display
+        URL and the URLs of its resized image copies are stored.
+        '''
+        experience_ids = [experience_id for (experience_id, ) in
+                          model.Session.query(model.Package.id)
+                          .join(model.PackageExtra,
+                                model.PackageExtra.package_id ==
+                                model.Package.id)
+                          .filter(model.Package.type == 'experience')
+                          .filter(model.Package.state == 'active')
+                          .filter(model.PackageExtra.key == 'image_url')
+                          .filter(model.PackageExtra.state == 'active')
+                          .all()]
+
+        site_user = get_action('get_site_user')({'ignore_auth': True}, {})
+        updated = 0
+        for experience_id in experience_ids:
+            try:
+                # the update schema works out image_display_url
+                get_action('package_patch')(
+                    {'user': site_user['name'], 'ignore_auth': True},
+                    {'id': experience_id})
+            except Exception as e:
+                print('There was a problem updating experience "{0}": {1}'
+                      .format(experience_id, e))
             else:
-                experience_title = self._gen_new_title(related.get('title'), related['id'])
-                data_dict = {
-                    'original_related_item_id': related.get('id'),
-                    'title': experience_title,
-                    'name': munge_title_to_name(experience_title),
-                    'notes': related.get('description'),
-                    'image_url': related.get('image_url'),
-                    'url': related.get('url'),
-                    'tags': [{"name": related.get('type').lower()}]
-                }
-                # make the experience
-                try:
-                    new_experience = get_action('ckanext_experience_create')(
-                        data_dict=data_dict)
-                except Exception as e:
-                    print('There was a problem migrating "{0}": {1}'.format(
-                        normalized_title, e))
-                else:
-                    print('Created Experience from the Related Item "{0}"'.format(normalized_title))
-
-                    # make the experience_package_association, if needed
-                    try:
-                        related_pkg_id = self._get_related_dataset(
-                            related['id'])
-                        if related_pkg_id:
-                            get_action('ckanext_experience_package_association_create')(
-                                data_dict={'experience_id': new_experience['id'],
-                                           'package_id': related_pkg_id})
-                    except Exception as e:
-                        print('There was a problem creating the experience_package_association for "{0}": {1}'.format(
-                            normalized_title, e))
-
-    def _get_related_dataset(self, related_id):
-        '''Get the id of a package from related_dataset, if one exists.'''
-        related_dataset = model.Session.query(model.RelatedDataset).filter_by(
-            related_id=related_id).first()
-        if related_dataset:
-            return related_dataset.dataset_id
+                updated += 1
+        print('Stored the image display URL of {0} experiences.'.format(
+            updated))
+
+    def reindex(self):
+        '''
+        Rebuild the search index of experiences and/or the datasets in them,
+        a batch at a time.
+        '''
+        since = None
+        if self.options.since:
+            try:
+                since = parse_date(self.options.since)
+            except ValueError:
+                print('"{0}" is not a valid timestamp'.format(
+                    self.options.since))
+                return
+
+        if self.options.experience:
+            experience = model.Package.get(self.options.experience)
+            if experience is None or experience.type != 'experience':
+                print('Experience "{0}" not found'.format(
+                    self.options.experience))
+                return
+            package_ids = _get_reindex_package_ids(
+                since, experience_id=experience.id, experiences=False)
+        else:
+            package_ids = _get_reindex_package_ids(
+                since, datasets=not self.options.experiences_only)
+
+        batch_size = self.options.batch_size
+        batches = [package_ids[start:start + batch_size]
+                   for start in range(0, len(package_ids), batch_size)]
+
+        pool = None
+        if self.options.workers > 1:
+            # don't let the worker processes share this process' database
+            # connections
+            model.Session.remove()
+            model.meta.engine.dispose()
+            pool = multiprocessing.Pool(self.options.workers)
+            results = pool.imap_unordered(_reindex_batch, batches)
+        else:
+            results = itertools.imap(_reindex_batch, batches)
+
+        reindexed = 0
+        try:
+            for batch_reindexed, messages in results:
+                for message in messages:
+                    print(message)
+                reindexed += batch_reindexed
+                print('Reindexed {0} of {1}'.format(reindexed,
+                                                    len(package_ids)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _read_checkpoint(self, checkpoint_file):
+        '''Return the id of the last migrated Related Item, if any.'''
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                return f.read().strip() or None
+
+    def _write_checkpoint(self, checkpoint_file, last_id):
+        '''Record the id of the last migrated Related Item.'''
+        tmp_file = checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(last_id)
+        os.rename(tmp_file, checkpoint_file)
+
+    def create_indexes(self):
+        '''
+        Create the indexes on the experience tables that are missing from the
+        database, e.g. because the tables were created by an older version of
+        ckanext-experience.
+        '''
+        created = create_missing_indexes()
+        if created:
+            for index_name in created:
+                print('Created index "{0}"'.format(index_name))
+        else:
+            print('All indexes already exist.')
+
+    def purge_deleted(self):
+        '''
+        Purge the experiences that were soft deleted.
+        '''
+        purged = purge_deleted_experiences(
+            batch_size=self.options.batch_size)
+        print('Purged {0} deleted experiences.'.format(purged))
 
     def _find_duplicates(self, lst):
-        '''From a list, return a set of duplicates.
+        '''From a list, return a list of duplicates, in the order they first
+        appear.
 
         >>> MigrationCommand('cmd')._find_duplicates([1, 2, 3, 4, 5])
         []
@@ -152,13 +374,282 @@ migration can continue. Please correct and try again:"""
         >>> MigrationCommand('cmd')._find_duplicates(['one', 'two', 'three', 'four', 'two', 'three'])
         ['two', 'three']
         '''
-        return list(set(x for x in lst if lst.count(x) >= 2))
+        counts = Counter(lst)
+        duplicates = []
+        for x in lst:
+            if counts[x] >= 2:
+                duplicates.append(x)
+                # only report each duplicate once
+                counts[x] = 0
+        return duplicates
 
-    def _gen_new_title(self, title, related_id):
-        name = munge_title_to_name(title)
-        pkg_obj = model.Session.query(model.Package).filter_by(name=name).first()
-        if pkg_obj:
-            title.replace('duplicate_', '')
-            return 'duplicate_' + title + '_' + related_id
+    def _find_name_collisions(self, titles):
+        '''From a list of titles, return an ordered dict mapping each
+        experience name made by more than one different title to those
+        titles.
+
+        >>> collisions = MigrationCommand('cmd')._find_name_collisions(['My Item', 'Other', 'my item', 'My Item'])
+        >>> len(collisions), collisions['my-item']
+        (1, ['My Item', 'my item'])
+        '''
+        names = OrderedDict()
+        for title in titles:
+            name_titles = names.setdefault(munge_title_to_name(title or ''), [])
+            if title not in name_titles:
+                name_titles.append(title)
+        return OrderedDict((name, name_titles)
+                           for name, name_titles in names.items()
+                           if len(name_titles) >= 2)
+
+    def _write_report(self, report_file, related_items, duplicate_titles,
+                      name_collisions):
+        '''Write a CSV row for each Related Item with a duplicate title or a
+        title that makes the same experience name as another title.'''
+        duplicate_titles = set(duplicate_titles)
+        with open(report_file, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['problem', 'related_item_id', 'title', 'name'])
+            for related_id, title in related_items:
+                name = munge_title_to_name(title or '')
+                if title in duplicate_titles:
+                    problem = 'duplicate_title'
+                elif name in name_collisions:
+                    problem = 'duplicate_name'
+                else:
+                    continue
+                writer.writerow([problem, related_id.encode('utf-8'),
+                                 (title or u'').encode('utf-8'),
+                                 name.encode('utf-8')])
+
+
+def _get_migrated_related_ids():
+    '''
+    Return the set of Related Item ids that active experiences have been
+    created from, in a single query.
+    '''
+    q = model.Session.query(model.PackageExtra.value) \
+        .join(model.Package,
+              model.Package.id == model.PackageExtra.package_id) \
+        .filter(model.PackageExtra.key == 'original_related_item_id') \
+        .filter(model.PackageExtra.state == 'active') \
+        .filter(model.Package.type == 'experience') \
+        .filter(model.Package.state == 'active')
+    return set(value for (value, ) in q.all())
+
+
+def _get_taken_names(names):
+    '''
+    Return the subset of the passed names that are already used by packages,
+    looked up in chunks of NAME_LOOKUP_CHUNK_SIZE names per query.
+    '''
+    names = list(names)
+    taken_names = set()
+    for start in range(0, len(names), NAME_LOOKUP_CHUNK_SIZE):
+        chunk = names[start:start + NAME_LOOKUP_CHUNK_SIZE]
+        taken_names.update(
+            name for (name, ) in model.Session.query(model.Package.name)
+            .filter(model.Package.name.in_(chunk)).all())
+    return taken_names
+
+
+def _related_item_batches(last_id, batch_size, migrated_ids, taken_names):
+    '''
+    Page through the Related Items after last_id, ordered by id, yielding
+    (id of the last item in the batch, list of related item dicts) tuples.
+
+    Each Related Item still to be migrated gets its experience title,
+    allocated against taken_names, which is updated with the new names.
+    '''
+    while True:
+        q = model.Session.query(model.Related).order_by(model.Related.id)
+        if last_id:
+            q = q.filter(model.Related.id > last_id)
+        related_items = q.limit(batch_size).all()
+        if not related_items:
+            return
+        last_id = related_items[-1].id
+
+        batch = []
+        for related in related_items:
+            migrated = related.id in migrated_ids
+            batch.append({
+                'id': related.id,
+                'title': related.title,
+                'description': related.description,
+                'image_url': related.image_url,
+                'url': related.url,
+                'type': related.type,
+                'migrated': migrated,
+                'experience_title': None if migrated else
+                _gen_new_title(related.title, related.id, taken_names)})
+        yield last_id, batch
+
+
+def _get_related_datasets(related_ids):
+    '''
+    Return a dict mapping the passed Related Item ids to the id of their
+    dataset, for those that have one, in a single query.
+    '''
+    if not related_ids:
+        return {}
+    q = model.Session.query(model.RelatedDataset.related_id,
+                            model.RelatedDataset.dataset_id) \
+        .join(model.Package,
+              model.Package.id == model.RelatedDataset.dataset_id) \
+        .filter(model.Package.type == 'dataset') \
+        .filter(model.RelatedDataset.related_id.in_(related_ids))
+    return dict(q.all())
+
+
+def _get_reindex_package_ids(since=None, experience_id=None,
+                             experiences=True, datasets=True):
+    '''
+    Return the ids of the packages that aren't deleted to reindex: the
+    experiences, if experiences is True, and the datasets in them (or in
+    experience_id only), if datasets is True. If since is given, only
+    packages modified since then are returned.
+    '''
+    package_ids = []
+    if experiences:
+        q = model.Session.query(model.Package.id) \
+            .filter(model.Package.type == 'experience') \
+            .filter(model.Package.state != 'deleted')
+        if since:
+            q = q.filter(model.Package.metadata_modified >= since)
+        package_ids.extend(package_id for (package_id, ) in q.all())
+
+    if datasets:
+        q = model.Session.query(model.Package.id) \
+            .join(ExperiencePackageAssociation,
+                  ExperiencePackageAssociation.package_id == model.Package.id) \
+            .filter(model.Package.state != 'deleted') \
+            .distinct()
+        if experience_id:
+            q = q.filter(
+                ExperiencePackageAssociation.experience_id == experience_id)
+        if since:
+            q = q.filter(model.Package.metadata_modified >= since)
+        package_ids.extend(package_id for (package_id, ) in q.all())
+
+    return package_ids
+
+
+def _reindex_batch(package_ids):
+    '''
+    Reindex a batch of packages and commit them to the search index once.
+    Returns the number of reindexed packages and a list of messages to print.
+
+    Runs in the worker processes when reindexing with --workers.
+    '''
+    package_index = search.index_for(model.Package)
+    context = {'model': model, 'ignore_auth': True, 'validate': False,
+               'use_cache': False}
+    reindexed = 0
+    messages = []
+    for package_id in package_ids:
+        try:
+            package_index.update_dict(
+                get_action('package_show')(dict(context), {'id': package_id}),
+                defer_commit=True)
+        except Exception as e:
+            messages.append('There was a problem reindexing package "{0}": '
+                            '{1}'.format(package_id, e))
         else:
-            return title
+            reindexed += 1
+    package_index.commit()
+    # don't hold the connection, or the objects loaded, between batches
+    model.Session.remove()
+    return reindexed, messages
+
+
+def _map_in_chunks(pool, func, iterable, chunk_size):
+    '''
+    Yield the results of calling func on each item of iterable in the pool's
+    processes, in order. Only chunk_size items are taken from iterable at a
+    time, unlike Pool.imap, which reads the whole of it straight away.
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        for result in pool.map(func, chunk):
+            yield result
+
+
+def _migrate_batch(batch):
+    '''
+    Create experiences, and their dataset associations, for a batch of
+    Related Items in one transaction. Returns the id of the batch's last
+    Related Item and a list of messages to print.
+
+    Runs in the worker processes when migrating with --workers.
+    '''
+    last_id, related_items = batch
+    messages = []
+    linked_ids = []
+    related_datasets = _get_related_datasets(
+        [related['id'] for related in related_items])
+
+    for related in related_items:
+        normalized_title = substitute_ascii_equivalents(related['title'])
+        if related['migrated']:
+            messages.append('Experience for Related Item "{0}" already exists.'
+                            .format(normalized_title))
+            continue
+
+        experience_title = related['experience_title']
+        data_dict = {
+            'original_related_item_id': related.get('id'),
+            'title': experience_title,
+            'name': munge_title_to_name(experience_title),
+            'notes': related.get('description'),
+            'image_url': related.get('image_url'),
+            'url': related.get('url'),
+            'tags': [{"name": related.get('type').lower()}]
+        }
+        # make the experience, committed with the rest of the batch. A
+        # failure only rolls back this item.
+        context = {'defer_commit': True, 'return_id_only': True}
+        savepoint = model.Session.begin_nested()
+        try:
+            experience_id = get_action('ckanext_experience_create')(
+                context, data_dict)
+            # make the experience_package_association, if needed
+            related_pkg_id = related_datasets.get(related['id'])
+            if related_pkg_id:
+                ExperiencePackageAssociation.create_many(experience_id,
+                                                         [related_pkg_id])
+            savepoint.commit()
+            if related_pkg_id:
+                linked_ids.append((experience_id, related_pkg_id))
+        except Exception as e:
+            savepoint.rollback()
+            messages.append('There was a problem migrating "{0}": {1}'.format(
+                normalized_title, e))
+        else:
+            messages.append('Created Experience from the Related Item "{0}"'
+                            .format(normalized_title))
+
+    model.repo.commit()
+
+    # as the association actions do
+    for experience_id, package_id in linked_ids:
+        experience_cache.num_datasets.invalidate(experience_id)
+    jobs.reindex_packages([package_id for (experience_id, package_id)
+                           in linked_ids])
+    return last_id, messages
+
+
+def _gen_new_title(title, related_id, taken_names):
+    '''
+    Return the experience title for a Related Item, prefixed with
+    'duplicate_' if its name is in taken_names, and add the name of the
+    returned title to taken_names.
+    '''
+    name = munge_title_to_name(title)
+    if name in taken_names:
+        title = 'duplicate_' + title + '_' + related_id
+        name = munge_title_to_name(title)
+    taken_names.add(name)
+    return title
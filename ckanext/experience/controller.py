@@ -53,6 +53,25 @@ NotAuthorized = tk.NotAuthorized
 log = logging.getLogger(__name__)
 
 
+def _get_page_number(params, key='page'):
+    '''
+    Return the page number in params under key, aborting with a 400 error if
+    it isn't a positive integer.
+    '''
+    try:
+        page = int(params.get(key, 1))
+        if page < 1:
+            raise ValueError
+    except ValueError:
+        abort(400, _('"{key}" parameter must be a positive integer').format(
+            key=key))
+    return page
+
+
+def _datasets_per_page():
+    return int(config.get('ckanext.experience.datasets_per_page', 20))
+
+
 class ExperienceController(PackageController):
 
     def new(self, data=None, errors=None, error_summary=None):
@@ -164,9 +183,27 @@ class ExperienceController(PackageController):
         except NotAuthorized:
             abort(401, _('Unauthorized to read experience'))
 
-        # get experience packages
+        # get a page of experience packages
+        page = _get_page_number(request.params)
+        limit = _datasets_per_page()
         c.experience_pkgs = get_action('ckanext_experience_package_list')(
-            context, {'experience_id': c.pkg_dict['id']})
+            context, {'experience_id': c.pkg_dict['id'],
+                      'limit': limit, 'offset': (page - 1) * limit})
+
+        def pager_url(q=None, page=None):
+            return h.url_for(
+                controller='ckanext.experience.controller:ExperienceController',
+                action='read', id=c.pkg_dict['name'], page=page)
+
+        c.experience_pkgs_page = h.Page(
+            collection=c.experience_pkgs,
+            page=page,
+            url=pager_url,
+            item_count=get_action('ckanext_experience_package_count')(
+                context, {'experience_id': c.pkg_dict['id']}),
+            items_per_page=limit
+        )
+        c.experience_pkgs_page.items = c.experience_pkgs
 
         package_type = DATASET_TYPE_NAME
         return render(self._read_template(package_type),
@@ -179,7 +216,8 @@ class ExperienceController(PackageController):
                 action='edit', id=id)
 
         context = {'model': model, 'session': model.Session,
-                   'user': c.user or c.author, 'auth_user_obj': c.userobj}
+                   'user': c.user or c.author, 'auth_user_obj': c.userobj,
+                   'experience_skip_enrichment': True}
 
         try:
             check_access('ckanext_experience_delete', context, {'id': id})
@@ -259,12 +297,10 @@ class ExperienceController(PackageController):
                 controller='ckanext.experience.controller:ExperienceController',
                 action='dataset_experience_list', id=c.pkg_dict['name']))
 
-        pkg_experience_ids = [experience['id'] for experience in c.experience_list]
-        site_experiences = get_action('ckanext_experience_list')(context, {})
-
-        c.experience_dropdown = [[experience['id'], experience['title']]
-                               for experience in site_experiences
-                               if experience['id'] not in pkg_experience_ids]
+        c.experience_dropdown = [
+            [experience_id, title] for (experience_id, title) in
+            ExperiencePackageAssociation.get_experiences_not_linked_to_package(
+                c.pkg_dict['id'])]
 
         return render("package/dataset_experience_list.html")
 
@@ -274,7 +310,8 @@ class ExperienceController(PackageController):
         '''
 
         context = {'model': model, 'session': model.Session,
-                   'user': c.user or c.author}
+                   'user': c.user or c.author,
+                   'experience_skip_enrichment': True}
         data_dict = {'id': id}
 
         try:
@@ -301,16 +338,17 @@ class ExperienceController(PackageController):
                 if param.startswith('dataset_'):
                     dataset_ids.append(param[8:])
             if dataset_ids:
-                for dataset_id in dataset_ids:
-                    get_action('ckanext_experience_package_association_delete')(
-                        context,
-                        {'experience_id': c.pkg_dict['id'],
-                         'package_id': dataset_id})
-                h.flash_success(
-                    ungettext(
-                        "The dataset has been removed from the experience.",
-                        "The datasets have been removed from the experience.",
-                        len(dataset_ids)))
+                results = get_action(
+                    'ckanext_experience_package_association_bulk_delete')(
+                        context, {'experience_id': c.pkg_dict['id'],
+                                  'package_ids': dataset_ids})
+                successful_removes = [r for r in results if r['success']]
+                if successful_removes:
+                    h.flash_success(
+                        ungettext(
+                            "The dataset has been removed from the experience.",
+                            "The datasets have been removed from the experience.",
+                            len(successful_removes)))
                 url = h.url_for(
                     controller='ckanext.experience.controller:ExperienceController',
                     action='manage_datasets', id=id)
@@ -326,17 +364,16 @@ class ExperienceController(PackageController):
                 if param.startswith('dataset_'):
                     dataset_ids.append(param[8:])
             if dataset_ids:
+                results = get_action(
+                    'ckanext_experience_package_association_bulk_create')(
+                        context, {'experience_id': c.pkg_dict['id'],
+                                  'package_ids': dataset_ids})
                 successful_adds = []
-                for dataset_id in dataset_ids:
-                    try:
-                        get_action(
-                            'ckanext_experience_package_association_create')(
-                                context, {'experience_id': c.pkg_dict['id'],
-                                          'package_id': dataset_id})
-                    except ValidationError as e:
-                        h.flash_notice(e.error_summary)
+                for result in results:
+                    if result['success']:
+                        successful_adds.append(result['package_id'])
                     else:
-                        successful_adds.append(dataset_id)
+                        h.flash_notice(result['message'])
                 if successful_adds:
                     h.flash_success(
                         ungettext(
@@ -350,9 +387,31 @@ class ExperienceController(PackageController):
 
         self._add_dataset_search(c.pkg_dict['id'], c.pkg_dict['name'])
 
-        # get experience packages
+        # get a page of experience packages, paged separately from the search
+        # results with the datasets_page param
+        datasets_page = _get_page_number(request.params, 'datasets_page')
+        limit = _datasets_per_page()
         c.experience_pkgs = get_action('ckanext_experience_package_list')(
-            context, {'experience_id': c.pkg_dict['id']})
+            context, {'experience_id': c.pkg_dict['id'],
+                      'limit': limit, 'offset': (datasets_page - 1) * limit})
+
+        params_nopage = [(k, v) for k, v in request.params.items()
+                         if k != 'datasets_page']
+
+        def pager_url(q=None, datasets_page=None):
+            params = list(params_nopage)
+            params.append(('datasets_page', datasets_page))
+            return self._search_url(params, c.pkg_dict['name'])
+
+        c.experience_pkgs_page = h.Page(
+            collection=c.experience_pkgs,
+            page=datasets_page,
+            url=pager_url,
+            item_count=get_action('ckanext_experience_package_count')(
+                context, {'experience_id': c.pkg_dict['id']}),
+            items_per_page=limit
+        )
+        c.experience_pkgs_page.items = c.experience_pkgs
 
         return render('experience/manage_datasets.html')
 
@@ -467,13 +526,9 @@ class ExperienceController(PackageController):
                     fq += ' +dataset_type:dataset'
 
             # Only search for packages that aren't already associated with the
-            # Experience
-            associated_package_ids = ExperiencePackageAssociation.get_package_ids_for_experience(experience_id)
-            # flatten resulting list to space separated string
-            if associated_package_ids:
-                associated_package_ids_str = \
-                    ' OR '.join([id[0] for id in associated_package_ids])
-                fq += ' !id:({0})'.format(associated_package_ids_str)
+            # Experience. Datasets are indexed with the ids of their
+            # experiences, see ExperiencePlugin.before_index.
+            fq += ' -vocab_experiences:"{0}"'.format(experience_id)
 
             facets = OrderedDict()
 
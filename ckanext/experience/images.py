@@ -0,0 +1,186 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    from PIL import Image
+except ImportError:  # resized images are optional
+    Image = None
+
+from ckanext.experience.logic.validators import experience_image_display_url
+from ckanext.experience.upload import count_image_references
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Widths, in pixels, of the resized copies made of uploaded experience
+# images. Configured with `ckanext.experience.image_widths`.
+widths = (320, 640, 1280)
+
+# Number of threads resizing images. Configured with
+# `ckanext.experience.image_workers`.
+workers = 4
+
+# (mime type, Pillow format, file extension, save options) of the resized
+# copies. WebP is skipped if Pillow was built without it.
+VARIANT_FORMATS = (
+    ('image/webp', 'WEBP', 'webp', {'quality': 75}),
+    ('image/jpeg', 'JPEG', 'jpg', {'quality': 80, 'optimize': True,
+                                   'progressive': True}),
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(workers)
+        return _pool
+
+
+def _variant_filename(filename, width, extension):
+    return '{0}-{1}w.{2}'.format(os.path.splitext(filename)[0], width,
+                                 extension)
+
+
+def _save_variant(args):
+    image, directory, filename, width, variant_format = args
+    mime_type, pil_format, extension, options = variant_format
+
+    variant_filename = _variant_filename(filename, width, extension)
+    variant = {'url': experience_image_display_url(variant_filename),
+               'width': width,
+               'type': mime_type,
+               'filename': variant_filename}
+    variant_filepath = os.path.join(directory, variant_filename)
+    if os.path.exists(variant_filepath):
+        # images are stored under the hash of their content, so it was made
+        # from the same image
+        return variant
+
+    height = int(round(image.size[1] * float(width) / image.size[0]))
+    resized = image.resize((width, height),
+                           getattr(Image, 'LANCZOS', Image.ANTIALIAS))
+    if pil_format == 'JPEG' and resized.mode != 'RGB':
+        resized = resized.convert('RGB')
+    try:
+        # write it under a temporary name, so a copy that exists is complete
+        resized.save(variant_filepath + '~', pil_format, **options)
+    except (IOError, KeyError) as e:
+        # e.g. Pillow without WebP support
+        log.debug('Could not save {0} as {1}: {2}'.format(
+            variant_filename, pil_format, e))
+        return None
+    os.rename(variant_filepath + '~', variant_filepath)
+    return variant
+
+
+def make_variants(filepath):
+    '''
+    Save resized copies of the uploaded image at filepath next to it, one per
+    configured width narrower than the image and per format, resizing in a
+    thread pool. Return a list of dicts with the url, width, mime type and
+    filename of each copy.
+
+    Return an empty list if Pillow isn't installed or the file can't be read
+    as an image, in which case only the original is served.
+    '''
+    if Image is None or not widths:
+        return []
+
+    try:
+        image = Image.open(filepath)
+        image.load()
+    except IOError as e:
+        log.warning('Could not read uploaded image {0}: {1}'.format(
+            filepath, e))
+        return []
+
+    start = time.time()
+    directory, filename = os.path.split(filepath)
+    jobs = [(image, directory, filename, width, variant_format)
+            for variant_format in VARIANT_FORMATS
+            for width in widths if width < image.size[0]]
+    variants = [variant for variant in _get_pool().map(_save_variant, jobs)
+                if variant is not None]
+    log.info('Made {0} resized copies of experience image {1} in {2:.1f}ms'
+             .format(len(variants), filename, (time.time() - start) * 1000))
+    return variants
+
+
+def remove_variants(directory, variants):
+    '''
+    Delete the files of the passed variants, as returned by make_variants,
+    from directory.
+    '''
+    for variant in variants:
+        try:
+            os.remove(os.path.join(directory, variant['filename']))
+        except OSError:
+            pass
+
+
+def remove_unused_variants(upload, image_url, variants):
+    '''
+    Delete the files of variants, the resized copies of the uploaded image
+    image_url, unless an experience still uses the image. Called once an
+    experience that stopped using it has been saved, or failed to be.
+    '''
+    storage_path = getattr(upload, 'storage_path', None)
+    if not variants or not storage_path or not image_url or \
+            image_url.startswith('http'):
+        return
+    if count_image_references(image_url) == 0:
+        remove_variants(storage_path, variants)
+
+
+def process_upload(upload, data_dict, old_image_url=None, old_variants=None):
+    '''
+    Set 'image_variants' in data_dict to the resized copies of the image just
+    saved by upload, a CKAN uploader. Copies are only made of images uploaded
+    to local storage.
+
+    If image_url is still old_image_url, old_variants (the stored list) are
+    kept. Otherwise they are returned, so the caller can delete them with
+    remove_unused_variants once the experience has been saved.
+    '''
+    filepath = getattr(upload, 'filepath', None)
+    if not getattr(upload, 'filename', None) and \
+            data_dict.get('image_url') == old_image_url:
+        # same image as before
+        if old_variants:
+            data_dict['image_variants'] = old_variants
+        else:
+            data_dict.pop('image_variants', None)
+        return []
+
+    variants = []
+    if filepath and os.path.exists(filepath):
+        variants = make_variants(filepath)
+    if variants:
+        data_dict['image_variants'] = variants
+    else:
+        data_dict.pop('image_variants', None)
+    return old_variants or []
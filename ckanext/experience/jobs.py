@@ -0,0 +1,108 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from ckan import model
+import ckan.lib.search as search
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.experience.model import ExperiencePackageAssociation
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# extra set on experiences deleted with `ckanext.experience.soft_delete`, so
+# they can be told apart from experiences deleted with package_delete
+SOFT_DELETED_KEY = 'experience_soft_deleted'
+
+
+def purge_deleted_experiences(experience_ids=None, batch_size=100):
+    '''
+    Purge experiences that have been soft deleted (see
+    `ckanext.experience.soft_delete`), committing after every batch_size
+    experiences so locks aren't held for the whole run. Experiences deleted
+    any other way, e.g. with package_delete, are left in the trash.
+
+    Can be run as a background job, or with `paster experience purge_deleted`.
+
+    :param experience_ids: only purge these experiences, if they are still
+        deleted (optional, default: all soft deleted experiences)
+    :type experience_ids: list of strings
+    :param batch_size: the number of experiences to purge per transaction
+    :type batch_size: int
+
+    :returns: the number of purged experiences
+    :rtype: int
+    '''
+    q = model.Session.query(model.Package.id) \
+        .join(model.PackageExtra,
+              model.PackageExtra.package_id == model.Package.id) \
+        .filter(model.PackageExtra.key == SOFT_DELETED_KEY) \
+        .filter(model.PackageExtra.state == 'active') \
+        .filter(model.Package.type == 'experience') \
+        .filter(model.Package.state == 'deleted')
+    if experience_ids:
+        q = q.filter(model.Package.id.in_(experience_ids))
+    ids = [experience_id for (experience_id, ) in q.all()]
+
+    purged = 0
+    for start in range(0, len(ids), batch_size):
+        dataset_ids = []
+        for experience_id in ids[start:start + batch_size]:
+            experience = model.Package.get(experience_id)
+            # skip experiences that were purged or restored in the meantime
+            if experience is None or experience.state != 'deleted':
+                continue
+            dataset_ids.extend(
+                package_id for (package_id, ) in
+                ExperiencePackageAssociation.get_package_ids_for_experience(
+                    experience_id))
+            experience.purge()
+            purged += 1
+        model.repo.commit()
+        # the purge deleted the experiences' associations too
+        reindex_packages(list(set(dataset_ids)))
+        log.info('Purged {0} of {1} deleted experiences'.format(purged,
+                                                                len(ids)))
+    return purged
+
+
+def reindex_packages(package_ids):
+    '''
+    Reindex the passed packages and commit them to the search index once,
+    e.g. to update the experiences a dataset is indexed as being in.
+    Packages that no longer exist are skipped.
+
+    The database session isn't committed, so it's safe to call before the
+    caller commits, e.g. from IDomainObjectModification.notify.
+
+    :param package_ids: ids of the packages to reindex
+    :type package_ids: list of strings
+    '''
+    if not package_ids:
+        return
+    package_index = search.index_for(model.Package)
+    context = {'model': model, 'ignore_auth': True, 'validate': False,
+               'use_cache': False}
+    for package_id in package_ids:
+        try:
+            pkg_dict = toolkit.get_action('package_show')(
+                dict(context), {'id': package_id})
+        except toolkit.ObjectNotFound:
+            continue
+        package_index.update_dict(pkg_dict, defer_commit=True)
+    package_index.commit()
@@ -22,14 +22,21 @@ import ckan.plugins.toolkit as toolkit
 from ckan.logic.converters import convert_user_name_or_id_to_id
 from ckan.lib.navl.dictization_functions import validate
 
+from ckanext.experience import cache as experience_cache
+from ckanext.experience import images as experience_images
+from ckanext.experience import upload as experience_upload
+from ckanext.experience import jobs
 import ckanext.experience.logic.converters as experience_converters
 import ckanext.experience.logic.schema as experience_schema
+from ckanext.experience.logic.validators import get_packages_for_names_or_ids
 from ckanext.experience.model import ExperiencePackageAssociation, ExperienceAdmin
 
 convert_package_name_or_id_to_title_or_name = \
     experience_converters.convert_package_name_or_id_to_title_or_name
 experience_package_association_create_schema = \
     experience_schema.experience_package_association_create_schema
+experience_package_association_bulk_create_schema = \
+    experience_schema.experience_package_association_bulk_create_schema
 experience_admin_add_schema = experience_schema.experience_admin_add_schema
 
 log = logging.getLogger(__name__)
@@ -41,20 +48,22 @@ def experience_create(context, data_dict):
     # force type to 'experience'
     data_dict['type'] = 'experience'
 
-    # If get_uploader is available (introduced for IUploader in CKAN 2.5), use
-    # it, otherwise use the default uploader.
-    # https://github.com/ckan/ckan/pull/2510
-    try:
-        upload = uploader.get_uploader('experience')
-    except AttributeError:
-        upload = uploader.Upload('experience')
+    upload = experience_upload.get_uploader()
 
     upload.update_data_dict(data_dict, 'image_url',
                             'image_upload', 'clear_upload')
 
     upload.upload(uploader.get_max_image_size())
+    experience_images.process_upload(upload, data_dict)
 
-    pkg = toolkit.get_action('package_create')(context, data_dict)
+    try:
+        pkg = toolkit.get_action('package_create')(context, data_dict)
+    except (toolkit.ValidationError, toolkit.NotAuthorized):
+        # don't leave resized copies of an image no experience uses behind
+        experience_images.remove_unused_variants(
+            upload, data_dict.get('image_url'),
+            data_dict.get('image_variants'))
+        raise
 
     return pkg
 
@@ -89,8 +98,81 @@ def experience_package_association_create(context, data_dict):
                                       error_summary=toolkit._(u"The dataset, {0}, is already in the experience").format(convert_package_name_or_id_to_title_or_name(package_id, context)))
 
     # create the association
-    return ExperiencePackageAssociation.create(package_id=package_id,
-                                             experience_id=experience_id)
+    association = ExperiencePackageAssociation.create(
+        package_id=package_id, experience_id=experience_id)
+    experience_cache.num_datasets.invalidate(experience_id)
+    jobs.reindex_packages([package_id, experience_id])
+
+    return association
+
+
+def experience_package_association_bulk_create(context, data_dict):
+    '''Create associations between a experience and several packages.
+
+    The packages are looked up in one query and the associations are created
+    in one statement and one transaction. Packages that can't be found or
+    are already in the experience are skipped.
+
+    :param experience_id: id or name of the experience to associate
+    :type experience_id: string
+
+    :param package_ids: ids or names of the packages to associate
+    :type package_ids: list of strings
+
+    :returns: a dict for each of the package_ids, with the package_id,
+        whether the association was created (success) and, if it wasn't, a
+        message saying why
+    :rtype: list of dictionaries
+    '''
+
+    model = context['model']
+
+    toolkit.check_access('ckanext_experience_package_association_bulk_create',
+                         context, data_dict)
+
+    # validate the incoming data_dict
+    validated_data_dict, errors = validate(
+        data_dict, experience_package_association_bulk_create_schema(),
+        context)
+
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    package_names_or_ids, experience_id = toolkit.get_or_bust(
+        validated_data_dict, ['package_ids', 'experience_id'])
+
+    packages = get_packages_for_names_or_ids(package_names_or_ids, context)
+    existing_ids = ExperiencePackageAssociation.get_linked_package_ids(
+        experience_id, [pkg.id for pkg in packages.values()])
+
+    results = []
+    new_ids = []
+    for package_name_or_id in package_names_or_ids:
+        pkg = packages.get(package_name_or_id)
+        if pkg is None:
+            results.append({
+                'package_id': package_name_or_id,
+                'success': False,
+                'message': '%s: %s' % (toolkit._('Not found'),
+                                       toolkit._('Dataset'))})
+        elif pkg.id in existing_ids:
+            results.append({
+                'package_id': pkg.id,
+                'success': False,
+                'message': toolkit._(u"The dataset, {0}, is already in the experience").format(pkg.title or pkg.name)})
+        else:
+            new_ids.append(pkg.id)
+            existing_ids.add(pkg.id)
+            results.append({'package_id': pkg.id, 'success': True})
+
+    # create the associations
+    if new_ids:
+        ExperiencePackageAssociation.create_many(experience_id, new_ids)
+        model.repo.commit()
+        experience_cache.num_datasets.invalidate(experience_id)
+        jobs.reindex_packages(new_ids + [experience_id])
+
+    return results
 
 
 def experience_admin_add(context, data_dict):
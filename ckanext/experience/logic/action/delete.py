@@ -16,15 +16,26 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import logging
+import datetime
 
+import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 from ckan.logic.converters import convert_user_name_or_id_to_id
 import ckan.lib.navl.dictization_functions
 
+try:
+    from ckan.common import config
+except ImportError:  # for ckan <= 2.5
+    from pylons import config
+
 from ckanext.experience.logic.schema import (
     experience_package_association_delete_schema,
+    experience_package_association_bulk_delete_schema,
     experience_admin_remove_schema)
+from ckanext.experience.logic.validators import get_packages_for_names_or_ids
 
+from ckanext.experience import cache as experience_cache
+from ckanext.experience import jobs
 from ckanext.experience.model import ExperiencePackageAssociation, ExperienceAdmin
 
 validate = ckan.lib.navl.dictization_functions.validate
@@ -36,6 +47,10 @@ def experience_delete(context, data_dict):
     '''Delete a experience. Experience delete cascades to
     ExperiencePackageAssociation objects.
 
+    If `ckanext.experience.soft_delete` is set, the experience is only marked
+    as deleted and is purged later, by a background job (CKAN >= 2.7) or by
+    `paster experience purge_deleted`.
+
     :param id: the id or name of the experience to delete
     :type id: string
     '''
@@ -50,9 +65,71 @@ def experience_delete(context, data_dict):
 
     toolkit.check_access('ckanext_experience_delete', context, data_dict)
 
-    entity.purge()
+    experience_id = entity.id
+
+    if toolkit.asbool(config.get('ckanext.experience.soft_delete', False)):
+        _soft_delete_experience(context, experience_id)
+    else:
+        dataset_ids = [
+            package_id for (package_id, ) in
+            ExperiencePackageAssociation.get_package_ids_for_experience(
+                experience_id)]
+        entity.purge()
+        model.repo.commit()
+        jobs.reindex_packages(dataset_ids)
+
+    experience_cache.num_datasets.invalidate(experience_id)
+
+
+def _soft_delete_experience(context, experience_id):
+    '''
+    Mark the experience as deleted, as package_delete does, and as soft
+    deleted, and remove its associations, committing once so either all of
+    it is saved or none of it is. Then reindex the datasets that were in it
+    and queue it for purging.
+    '''
+    model = context['model']
+    user = context.get('user')
+    entity = model.Package.get(experience_id)
+
+    dataset_ids = [package_id for (package_id, ) in
+                   ExperiencePackageAssociation.get_package_ids_for_experience(
+                       experience_id)]
+
+    # package_delete commits straight away, so do what it does here, in the
+    # same transaction as the rest
+    rev = model.repo.new_revision()
+    rev.author = user
+    rev.message = toolkit._(u'REST API: Delete Package: %s') % entity.name
+
+    for item in plugins.PluginImplementations(plugins.IPackageController):
+        item.delete(entity)
+        item.after_delete(context, {'id': experience_id})
+
+    entity.delete()
+    for membership in model.Session.query(model.Member) \
+            .filter(model.Member.table_id == experience_id) \
+            .filter(model.Member.state == 'active').all():
+        membership.delete()
+
+    entity.extras[jobs.SOFT_DELETED_KEY] = \
+        datetime.datetime.utcnow().isoformat()
+    ExperiencePackageAssociation.delete_for_experience(experience_id)
     model.repo.commit()
 
+    jobs.reindex_packages(dataset_ids)
+
+    if toolkit.check_ckan_version(min_version='2.7'):
+        try:
+            toolkit.enqueue_job(jobs.purge_deleted_experiences,
+                                [[experience_id]],
+                                title='Purge experience {0}'.format(
+                                    experience_id))
+        except Exception as e:
+            log.warning('Could not queue the purge of experience {0}, run '
+                        '`paster experience purge_deleted` to purge it: {1}'
+                        .format(experience_id, e))
+
 
 def experience_package_association_delete(context, data_dict):
     '''Delete an association between a experience and a package.
@@ -90,6 +167,78 @@ def experience_package_association_delete(context, data_dict):
     experience_package_association.delete()
     model.repo.commit()
 
+    experience_cache.num_datasets.invalidate(experience_id)
+    jobs.reindex_packages([package_id, experience_id])
+
+
+def experience_package_association_bulk_delete(context, data_dict):
+    '''Delete the associations between a experience and several packages.
+
+    The packages are looked up in one query and the associations are deleted
+    in one statement and one transaction. Packages that can't be found or
+    aren't in the experience are skipped.
+
+    :param experience_id: id or name of the experience in the associations
+    :type experience_id: string
+
+    :param package_ids: ids or names of the packages in the associations
+    :type package_ids: list of strings
+
+    :returns: a dict for each of the package_ids, with the package_id,
+        whether the association was deleted (success) and, if it wasn't, a
+        message saying why
+    :rtype: list of dictionaries
+    '''
+
+    model = context['model']
+
+    toolkit.check_access('ckanext_experience_package_association_bulk_delete',
+                         context, data_dict)
+
+    # validate the incoming data_dict
+    validated_data_dict, errors = validate(
+        data_dict, experience_package_association_bulk_delete_schema(),
+        context)
+
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    package_names_or_ids, experience_id = toolkit.get_or_bust(
+        validated_data_dict, ['package_ids', 'experience_id'])
+
+    packages = get_packages_for_names_or_ids(package_names_or_ids, context)
+    linked_ids = ExperiencePackageAssociation.get_linked_package_ids(
+        experience_id, [pkg.id for pkg in packages.values()])
+
+    results = []
+    deleted_ids = []
+    for package_name_or_id in package_names_or_ids:
+        pkg = packages.get(package_name_or_id)
+        if pkg is None:
+            results.append({
+                'package_id': package_name_or_id,
+                'success': False,
+                'message': '%s: %s' % (toolkit._('Not found'),
+                                       toolkit._('Dataset'))})
+        elif pkg.id not in linked_ids:
+            results.append({
+                'package_id': pkg.id,
+                'success': False,
+                'message': toolkit._(u"The dataset, {0}, is not in the experience").format(pkg.title or pkg.name)})
+        else:
+            deleted_ids.append(pkg.id)
+            linked_ids.discard(pkg.id)
+            results.append({'package_id': pkg.id, 'success': True})
+
+    # delete the associations
+    if deleted_ids:
+        ExperiencePackageAssociation.delete_many(experience_id, deleted_ids)
+        model.repo.commit()
+        experience_cache.num_datasets.invalidate(experience_id)
+        jobs.reindex_packages(deleted_ids + [experience_id])
+
+    return results
+
 
 def experience_admin_remove(context, data_dict):
     '''Remove a user to the list of experience admins.
@@ -22,7 +22,10 @@ import ckan.lib.dictization.model_dictize as model_dictize
 from ckan.lib.navl.dictization_functions import validate
 from ckan.logic import NotAuthorized
 
-from ckanext.experience.logic.schema import (experience_package_list_schema,
+from ckanext.experience import cache as experience_cache
+from ckanext.experience.logic.schema import (experience_list_schema,
+                                           experience_package_list_schema,
+                                           experience_package_count_schema,
                                            package_experience_list_schema)
 from ckanext.experience.model import ExperiencePackageAssociation, ExperienceAdmin
 
@@ -33,16 +36,130 @@ _select = sqlalchemy.sql.select
 _and_ = sqlalchemy.and_
 
 
+# number of packages looked up per package_search query, well below Solr's
+# default limit of 1024 clauses per query
+SEARCH_BATCH_SIZE = 100
+
+
+def _search_packages(context, package_ids, dataset_type=None):
+    '''
+    Return the package dicts for the passed package ids, in the same order,
+    as package_search returns them: from the search index, fetching up to
+    SEARCH_BATCH_SIZE packages per query. Packages missing from the index
+    are looked up with package_show, and left out if the user in context
+    isn't authorized to read them.
+
+    Callers are expected to have already filtered out the packages the user
+    can't read, so private packages are searched for too.
+    '''
+    pkg_dicts = {}
+    for start in range(0, len(package_ids), SEARCH_BATCH_SIZE):
+        batch = package_ids[start:start + SEARCH_BATCH_SIZE]
+        fq = u'id:({0})'.format(u' OR '.join(u'"{0}"'.format(package_id)
+                                             for package_id in batch))
+        if dataset_type:
+            # stops ExperiencePlugin.before_search from excluding experiences
+            fq = u'+dataset_type:{0} {1}'.format(dataset_type, fq)
+        search_dict = {'fq': fq, 'rows': len(batch)}
+        if toolkit.check_ckan_version(min_version='2.6'):
+            search_dict['include_private'] = True
+        search_context = dict(context, ignore_capacity_check=True)
+        results = toolkit.get_action('package_search')(
+            search_context, search_dict)['results']
+        for pkg_dict in results:
+            pkg_dicts[pkg_dict['id']] = pkg_dict
+
+    pkg_list = []
+    for package_id in package_ids:
+        pkg_dict = pkg_dicts.get(package_id)
+        if pkg_dict is None:
+            log.debug('Package with ID {0} is not in the search index'
+                      .format(package_id))
+            try:
+                pkg_dict = toolkit.get_action('package_show')(
+                    dict(context), {'id': package_id})
+            except (NotAuthorized, toolkit.ObjectNotFound):
+                log.debug('Not authorized to access Package with ID: ' +
+                          str(package_id))
+                continue
+        pkg_list.append(pkg_dict)
+    return pkg_list
+
+
+def _get_user_obj(context):
+    '''
+    Return the User object of the user in context, or None if they are
+    anonymous.
+    '''
+    user_obj = context.get('auth_user_obj')
+    if user_obj is None and context.get('user'):
+        # anonymous users are passed by IP address, which matches no user
+        user_obj = context['model'].User.get(context['user'])
+    return user_obj
+
+
+def get_readable_organization_ids(context):
+    '''
+    Return the ids of the organizations whose private datasets the user in
+    context can read, or None if they can read all private datasets because
+    they are a sysadmin. Anonymous users get an empty list.
+
+    The result is kept in the context, so it's only looked up once per
+    action call.
+    '''
+    model = context['model']
+    key = 'experience_readable_organization_ids'
+    if key not in context:
+        user_obj = _get_user_obj(context)
+        if user_obj is None:
+            context[key] = []
+        elif user_obj.sysadmin:
+            context[key] = None
+        else:
+            organizations = toolkit.get_action('organization_list_for_user')(
+                {'model': model, 'session': model.Session,
+                 'user': user_obj.name},
+                {'permission': 'read'})
+            context[key] = [organization['id']
+                            for organization in organizations]
+    return context[key]
+
+
+def _readable_filter(context):
+    '''
+    Return the keyword arguments restricting ExperiencePackageAssociation
+    queries to the packages the user in context can read.
+    '''
+    organization_ids = get_readable_organization_ids(context)
+    if organization_ids is None:
+        return {'include_private': True}
+    return {'organization_ids': organization_ids}
+
+
 @toolkit.side_effect_free
 def experience_show(context, data_dict):
     '''Return the pkg_dict for a experience (package).
 
     :param id: the id or name of the experience
     :type id: string
+    :param notes_formatted: whether to include the rendered description,
+        experience_notes_formatted (optional, default: true, unless
+        ckanext.experience.api_notes_formatted is off for API calls)
+    :type notes_formatted: bool
     '''
 
     toolkit.check_access('ckanext_experience_show', context, data_dict)
 
+    data_dict = dict(data_dict)
+    try:
+        notes_formatted = toolkit.asbool(
+            data_dict.pop('notes_formatted', True))
+    except ValueError:
+        raise toolkit.ValidationError(
+            {'notes_formatted': [toolkit._('Must be a boolean')]})
+    if not notes_formatted:
+        context['experience_skip_notes_formatted'] = True
+
     pkg_dict = toolkit.get_action('package_show')(context, data_dict)
 
     return pkg_dict
@@ -50,16 +167,58 @@ def experience_show(context, data_dict):
 
 @toolkit.side_effect_free
 def experience_list(context, data_dict):
-    '''Return a list of all experiences in the site.'''
+    '''Return a list of all experiences in the site, ordered by name.
+
+    :param limit: the maximum number of experiences to return (optional)
+    :type limit: int
+    :param cursor: the name of the last experience of the previous page;
+        only experiences after it are returned (optional)
+    :type cursor: string
+    :param fields: only return these fields for each experience, any of
+        'id', 'name' and 'title', instead of the full experience dicts
+        (optional)
+    :type fields: list of strings
+
+    :rtype: list of dictionaries
+    '''
 
     toolkit.check_access('ckanext_experience_list', context, data_dict)
 
+    # validate the incoming data_dict
+    validated_data_dict, errors = validate(data_dict,
+                                           experience_list_schema(),
+                                           context)
+
+    if errors:
+        raise toolkit.ValidationError(errors)
+
     model = context["model"]
+    fields = validated_data_dict.get('fields')
 
-    q = model.Session.query(model.Package) \
-        .filter(model.Package.type == 'experience') \
+    if fields:
+        # only load the requested columns, no need for the ORM objects
+        q = model.Session.query(
+            *[getattr(model.Package, field) for field in fields])
+    else:
+        q = model.Session.query(model.Package)
+
+    q = q.filter(model.Package.type == 'experience') \
         .filter(model.Package.state == 'active')
 
+    # keyset pagination on the (unique) name, so later pages cost the same as
+    # the first one
+    cursor = validated_data_dict.get('cursor')
+    if cursor:
+        q = q.filter(model.Package.name > cursor)
+    q = q.order_by(model.Package.name)
+
+    limit = validated_data_dict.get('limit')
+    if limit is not None:
+        q = q.limit(limit)
+
+    if fields:
+        return [dict(zip(fields, row)) for row in q.all()]
+
     experience_list = []
     for pkg in q.all():
         experience_list.append(model_dictize.package_dictize(pkg, context))
@@ -71,8 +230,20 @@ def experience_list(context, data_dict):
 def experience_package_list(context, data_dict):
     '''List packages associated with a experience.
 
+    Private datasets are listed if the user can read them, i.e. they are a
+    sysadmin or a member of the dataset's organization.
+
     :param experience_id: id or name of the experience
     :type experience_id: string
+    :param limit: the maximum number of packages to return (optional)
+    :type limit: int
+    :param offset: the number of packages to skip, for paging (optional,
+        default: 0)
+    :type offset: int
+    :param sort: the package field to order by, one of 'title', 'name' or
+        'metadata_modified', followed by 'asc' or 'desc' (optional, default:
+        'title asc')
+    :type sort: string
 
     :rtype: list of dictionaries
     '''
@@ -87,32 +258,84 @@ def experience_package_list(context, data_dict):
     if errors:
         raise toolkit.ValidationError(errors)
 
-    # get a list of package ids associated with experience id
-    pkg_id_list = ExperiencePackageAssociation.get_package_ids_for_experience(
-        validated_data_dict['experience_id'])
+    # get a page of the ids of the active packages associated with experience
+    # id in one query, then the packages from the search index
+    package_ids = \
+        ExperiencePackageAssociation.get_active_package_ids_for_experience(
+            validated_data_dict['experience_id'],
+            limit=validated_data_dict.get('limit'),
+            offset=validated_data_dict.get('offset', 0),
+            sort=validated_data_dict.get('sort', 'title asc'),
+            **_readable_filter(context))
 
-    pkg_list = []
-    if pkg_id_list is not None:
-        # for each package id, get the package dict and append to list if
-        # active
-        for pkg_id in pkg_id_list:
-            try:
-                pkg = toolkit.get_action('package_show')(context,
-                                                         {'id': pkg_id})
-                if pkg['state'] == 'active':
-                    pkg_list.append(pkg)
-            except NotAuthorized:
-                log.debug(
-                    'Not authorized to access Package with ID: ' + str(pkg_id))
-    return pkg_list
+    return _search_packages(context, package_ids)
+
+
+@toolkit.side_effect_free
+def experience_package_count(context, data_dict):
+    '''Return the number of active datasets associated with a experience.
+
+    Private datasets are counted if the user can read them, i.e. they are a
+    sysadmin or a member of the dataset's organization. When
+    `ckanext.experience.num_datasets_cache_ttl` is set, the count of public
+    datasets is cached for that many seconds.
+
+    :param experience_id: id or name of the experience
+    :type experience_id: string
+
+    :rtype: int
+    '''
+
+    toolkit.check_access('ckanext_experience_package_count', context,
+                         data_dict)
+
+    # validate the incoming data_dict
+    validated_data_dict, errors = validate(data_dict,
+                                           experience_package_count_schema(),
+                                           context)
+
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    return count_experience_datasets(context,
+                                     validated_data_dict['experience_id'])
+
+
+def count_experience_datasets(context, experience_id):
+    '''
+    Return the number of active datasets associated with the experience id,
+    as experience_package_count does, without its validation and auth check.
+    For internal callers that already have the experience id.
+    '''
+    readable_filter = _readable_filter(context)
+    if readable_filter.get('include_private') or \
+            readable_filter.get('organization_ids'):
+        # only counts of public datasets are the same for everyone
+        return ExperiencePackageAssociation.count_packages_for_experience(
+            experience_id, **readable_filter)
+
+    count = experience_cache.num_datasets.get(experience_id)
+    if count is None:
+        count = ExperiencePackageAssociation.count_packages_for_experience(
+            experience_id)
+        experience_cache.num_datasets.set(experience_id, count)
+    return count
 
 
 @toolkit.side_effect_free
 def package_experience_list(context, data_dict):
     '''List experiences associated with a package.
 
+    Private experiences are listed if the user can read them, i.e. they are
+    a sysadmin or a member of the experience's organization.
+
     :param package_id: id or name of the package
     :type package_id: string
+    :param limit: the maximum number of experiences to return (optional)
+    :type limit: int
+    :param offset: the number of experiences to skip, for paging (optional,
+        default: 0)
+    :type offset: int
 
     :rtype: list of dictionaries
     '''
@@ -127,23 +350,17 @@ def package_experience_list(context, data_dict):
     if errors:
         raise toolkit.ValidationError(errors)
 
-    # get a list of experience ids associated with the package id
-    experience_id_list = ExperiencePackageAssociation.get_experience_ids_for_package(
-        validated_data_dict['package_id'])
-
-    experience_list = []
-    if experience_id_list is not None:
-        for experience_id in experience_id_list:
-            try:
-                experience = toolkit.get_action('package_show')(
-                    context,
-                    {'id': experience_id}
-                )
-                experience_list.append(experience)
-            except NotAuthorized:
-                log.debug('Not authorized to access Package with ID: '
-                          + str(experience_id))
-    return experience_list
+    # get a page of the ids of the active experiences associated with the
+    # package id in one query, then the experiences from the search index
+    experience_ids = \
+        ExperiencePackageAssociation.get_active_experience_ids_for_package(
+            validated_data_dict['package_id'],
+            limit=validated_data_dict.get('limit'),
+            offset=validated_data_dict.get('offset', 0),
+            **_readable_filter(context))
+
+    return _search_packages(context, experience_ids,
+                            dataset_type='experience')
 
 
 @toolkit.side_effect_free
@@ -20,25 +20,49 @@ import logging
 import ckan.lib.uploader as uploader
 import ckan.plugins.toolkit as toolkit
 
+from ckanext.experience import images as experience_images
+from ckanext.experience import upload as experience_upload
+from ckanext.experience.logic.validators import image_variants_from_json
+
 
 log = logging.getLogger(__name__)
 
 
 def experience_update(context, data_dict):
 
-    # If get_uploader is available (introduced for IUploader in CKAN 2.5), use
-    # it, otherwise use the default uploader.
-    # https://github.com/ckan/ckan/pull/2510
-    try:
-        upload = uploader.get_uploader('experience', data_dict['image_url'])
-    except AttributeError:
-        upload = uploader.Upload('experience', data_dict['image_url'])
+    upload = experience_upload.get_uploader(data_dict['image_url'])
 
     upload.update_data_dict(data_dict, 'image_url',
                             'image_upload', 'clear_upload')
 
     upload.upload(uploader.get_max_image_size())
 
-    pkg = toolkit.get_action('package_update')(context, data_dict)
+    # the form doesn't send the resized copies, so keep the stored ones
+    # unless the image changed
+    model = context['model']
+    experience = model.Package.get(data_dict.get('id') or
+                                   data_dict.get('name'))
+    old_image_url = old_variants = None
+    if experience:
+        old_image_url = experience.extras.get('image_url')
+        old_variants = image_variants_from_json(
+            experience.extras.get('image_variants'), context)
+    unused_variants = experience_images.process_upload(
+        upload, data_dict, old_image_url=old_image_url,
+        old_variants=old_variants)
+
+    try:
+        pkg = toolkit.get_action('package_update')(context, data_dict)
+    except (toolkit.ValidationError, toolkit.NotAuthorized):
+        # the stored copies are still in use, only new ones can go
+        if data_dict.get('image_url') != old_image_url:
+            experience_images.remove_unused_variants(
+                upload, data_dict.get('image_url'),
+                data_dict.get('image_variants'))
+        raise
+
+    # only delete the old copies once the experience no longer uses them
+    experience_images.remove_unused_variants(upload, old_image_url,
+                                             unused_variants)
 
     return pkg
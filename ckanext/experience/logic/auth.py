@@ -28,8 +28,11 @@ def _is_experience_admin(context):
     '''
     Determines whether user in context is in the experience admin list.
     '''
-    user = context.get('user', '')
-    userobj = model.User.get(user)
+    # check_access has usually looked the user up already
+    userobj = context.get('auth_user_obj')
+    if userobj is None:
+        user = context.get('user', '')
+        userobj = model.User.get(user) if user else None
     return ExperienceAdmin.is_user_experience_admin(userobj)
 
 
@@ -87,12 +90,36 @@ def package_association_delete(context, data_dict):
     return {'success': _is_experience_admin(context)}
 
 
+def package_association_bulk_create(context, data_dict):
+    '''Create several package experience associations at once.
+
+       Only sysadmins or user listed as Experience Admins can create
+       package/experience associations.
+    '''
+    return {'success': _is_experience_admin(context)}
+
+
+def package_association_bulk_delete(context, data_dict):
+    '''Delete several package experience associations at once.
+
+       Only sysadmins or user listed as Experience Admins can delete
+       package/experience associations.
+    '''
+    return {'success': _is_experience_admin(context)}
+
+
 @toolkit.auth_allow_anonymous_access
 def experience_package_list(context, data_dict):
     '''All users can access a experience's package list'''
     return {'success': True}
 
 
+@toolkit.auth_allow_anonymous_access
+def experience_package_count(context, data_dict):
+    '''All users can access a experience's package count'''
+    return {'success': True}
+
+
 @toolkit.auth_allow_anonymous_access
 def package_experience_list(context, data_dict):
     '''All users can access a packages's experience list'''
@@ -15,9 +15,14 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from sqlalchemy import func
+
 import ckan.lib.helpers as h
+import ckan.model as model
 from ckan.plugins import toolkit as tk
 
+from ckanext.experience import cache as experience_cache
+
 
 def facet_remove_field(key, value=None, replace=None):
     '''
@@ -30,19 +35,52 @@ def facet_remove_field(key, value=None, replace=None):
         action='search')
 
 
+def _count_groups(is_organization):
+    '''
+    Return the number of active groups, or organizations, as listed by
+    group_list and organization_list.
+    '''
+    return model.Session.query(func.count(model.Group.id)) \
+        .filter(model.Group.is_organization == is_organization) \
+        .filter(model.Group.type ==
+                ('organization' if is_organization else 'group')) \
+        .filter(model.Group.state == 'active') \
+        .scalar()
+
+
 def get_site_statistics():
     '''
     Custom stats helper, so we can get the correct number of packages, and a
     count of experiences.
+
+    The stats are cached for `ckanext.experience.site_stats_cache_ttl`
+    seconds.
     '''
 
+    stats = experience_cache.site_stats.get('site_statistics')
+    if stats is not None:
+        return stats
+
     stats = {}
     stats['experience_count'] = tk.get_action('package_search')(
-        {}, {"rows": 1, 'fq': 'dataset_type:experience'})['count']
+        {}, {"rows": 0, 'fq': 'dataset_type:experience'})['count']
     stats['dataset_count'] = tk.get_action('package_search')(
-        {}, {"rows": 1, 'fq': '!dataset_type:experience'})['count']
-    stats['group_count'] = len(tk.get_action('group_list')({}, {}))
-    stats['organization_count'] = len(
-        tk.get_action('organization_list')({}, {}))
+        {}, {"rows": 0, 'fq': '!dataset_type:experience'})['count']
+    stats['group_count'] = _count_groups(is_organization=False)
+    stats['organization_count'] = _count_groups(is_organization=True)
+
+    experience_cache.site_stats.set('site_statistics', stats)
 
     return stats
+
+
+def experience_image_srcset(package, mime_type):
+    '''
+    Return a srcset attribute value listing the resized copies of the
+    experience's image of the passed mime type, e.g. 'image/webp', or an
+    empty string if there are none.
+    '''
+    return ', '.join(
+        '{0} {1}w'.format(variant['url'], variant['width'])
+        for variant in package.get('image_variants') or []
+        if variant.get('type') == mime_type)
@@ -23,6 +23,8 @@ from ckan.lib.navl.validators import (not_empty,
                                       ignore,
                                       keep_extras)
 from ckan.logic.validators import (package_id_not_changed,
+                                   natural_number_validator,
+                                   list_of_strings,
                                    name_validator,
                                    user_id_or_name_exists,
                                    package_name_validator,
@@ -35,7 +37,12 @@ from ckan.logic.schema import (default_tags_schema,
 
 from ckanext.experience.logic.validators import (
     convert_package_name_or_id_to_id_for_type_dataset,
-    convert_package_name_or_id_to_id_for_type_experience)
+    convert_package_name_or_id_to_id_for_type_experience,
+    experience_package_list_sort,
+    experience_list_fields,
+    image_display_url_from_image_url,
+    image_variants_to_json,
+    image_variants_from_json)
 
 
 def experience_base_schema():
@@ -61,6 +68,11 @@ def experience_base_schema():
         'return_to': [ignore],
         'image_url': [toolkit.get_validator('ignore_missing'),
                       toolkit.get_converter('convert_to_extras')],
+        'image_display_url': [image_display_url_from_image_url,
+                              toolkit.get_converter('convert_to_extras')],
+        'image_variants': [toolkit.get_validator('ignore_missing'),
+                           image_variants_to_json,
+                           toolkit.get_converter('convert_to_extras')],
         'original_related_item_id': [
             toolkit.get_validator('ignore_missing'),
             toolkit.get_converter('convert_to_extras')]
@@ -123,6 +135,11 @@ def experience_show_schema():
     schema.update({
         'image_url': [toolkit.get_converter('convert_from_extras'),
                       toolkit.get_validator('ignore_missing')],
+        'image_display_url': [toolkit.get_converter('convert_from_extras'),
+                              toolkit.get_validator('ignore_missing')],
+        'image_variants': [toolkit.get_converter('convert_from_extras'),
+                           toolkit.get_validator('ignore_missing'),
+                           image_variants_from_json],
         'original_related_item_id': [
             toolkit.get_converter('convert_from_extras'),
             toolkit.get_validator('ignore_missing')]
@@ -131,6 +148,15 @@ def experience_show_schema():
     return schema
 
 
+def experience_list_schema():
+    schema = {
+        'limit': [ignore_missing, natural_number_validator],
+        'cursor': [ignore_missing, unicode],
+        'fields': [ignore_missing, experience_list_fields]
+    }
+    return schema
+
+
 def experience_package_association_create_schema():
     schema = {
         'package_id': [not_empty, unicode,
@@ -145,7 +171,31 @@ def experience_package_association_delete_schema():
     return experience_package_association_create_schema()
 
 
+def experience_package_association_bulk_create_schema():
+    schema = {
+        'package_ids': [not_empty, list_of_strings],
+        'experience_id': [not_empty, unicode,
+                        convert_package_name_or_id_to_id_for_type_experience]
+    }
+    return schema
+
+
+def experience_package_association_bulk_delete_schema():
+    return experience_package_association_bulk_create_schema()
+
+
 def experience_package_list_schema():
+    schema = {
+        'experience_id': [not_empty, unicode,
+                        convert_package_name_or_id_to_id_for_type_experience],
+        'limit': [ignore_missing, natural_number_validator],
+        'offset': [ignore_missing, natural_number_validator],
+        'sort': [ignore_missing, unicode, experience_package_list_sort]
+    }
+    return schema
+
+
+def experience_package_count_schema():
     schema = {
         'experience_id': [not_empty, unicode,
                         convert_package_name_or_id_to_id_for_type_experience]
@@ -156,7 +206,9 @@ def experience_package_list_schema():
 def package_experience_list_schema():
     schema = {
         'package_id': [not_empty, unicode,
-                       convert_package_name_or_id_to_id_for_type_dataset]
+                       convert_package_name_or_id_to_id_for_type_dataset],
+        'limit': [ignore_missing, natural_number_validator],
+        'offset': [ignore_missing, natural_number_validator]
     }
     return schema
 
@@ -15,11 +15,41 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import os
+import re
+import json
+
+from sqlalchemy import or_
+
+from ckan.lib.navl.dictization_functions import missing, StopOnError
 from ckan.plugins import toolkit as tk
 
+try:
+    from ckan.common import config
+except ImportError:  # for ckan <= 2.5
+    from pylons import config
+
 _ = tk._
 Invalid = tk.Invalid
 
+# keys and mime types of the resized image copies, see images.make_variants
+IMAGE_VARIANT_KEYS = ('url', 'width', 'type', 'filename')
+IMAGE_VARIANT_TYPES = ('image/webp', 'image/jpeg')
+
+# package fields the experience package list can be sorted by
+PACKAGE_LIST_SORT_FIELDS = ('title', 'name', 'metadata_modified')
+
+# package columns the experience list can be projected to
+EXPERIENCE_LIST_FIELDS = ('id', 'name', 'title')
+
+
+def _package_id_memo(context):
+    '''
+    Return the dict, kept in the context, that maps (package_type, name or
+    id) to the package ids already resolved while handling this request.
+    '''
+    return context.setdefault('experience_package_id_memo', {})
+
 
 def convert_package_name_or_id_to_id_for_type(package_name_or_id,
                                               context, package_type='dataset'):
@@ -35,16 +65,24 @@ def convert_package_name_or_id_to_id_for_type(package_name_or_id,
         package with the given name or id
 
     '''
+    memo = _package_id_memo(context)
+    key = (package_type, package_name_or_id)
+    if key in memo:
+        return memo[key]
+
     session = context['session']
     model = context['model']
-    result = session.query(model.Package) \
-        .filter_by(id=package_name_or_id, type=package_type).first()
-    if not result:
-        result = session.query(model.Package) \
-            .filter_by(name=package_name_or_id, type=package_type).first()
-    if not result:
+    ids = [id for (id, ) in session.query(model.Package.id)
+           .filter(model.Package.type == package_type)
+           .filter(or_(model.Package.id == package_name_or_id,
+                       model.Package.name == package_name_or_id)).all()]
+    if not ids:
         raise Invalid('%s: %s' % (_('Not found'), _('Dataset')))
-    return result.id
+
+    # a match on id takes precedence over a match on name
+    package_id = package_name_or_id if package_name_or_id in ids else ids[0]
+    memo[key] = package_id
+    return package_id
 
 
 def convert_package_name_or_id_to_id_for_type_dataset(package_name_or_id,
@@ -59,3 +97,160 @@ def convert_package_name_or_id_to_id_for_type_experience(package_name_or_id,
     return convert_package_name_or_id_to_id_for_type(package_name_or_id,
                                                      context,
                                                      package_type='experience')
+
+
+def get_packages_for_names_or_ids(package_names_or_ids, context,
+                                  package_type='dataset'):
+    '''
+    Look up the packages of type package_type for a list of package names or
+    ids in a single query. This is the batch version of
+    convert_package_name_or_id_to_id_for_type, and shares its memo.
+
+    :returns: a dict mapping each of the given names or ids to an
+        (id, name, title) row for its package. Names or ids with no package
+        are left out. As with convert_package_name_or_id_to_id_for_type, a
+        match on id takes precedence over a match on name.
+    :rtype: dict
+    '''
+    if not package_names_or_ids:
+        return {}
+
+    session = context['session']
+    model = context['model']
+    rows = session.query(model.Package.id, model.Package.name,
+                         model.Package.title) \
+        .filter(model.Package.type == package_type) \
+        .filter(or_(model.Package.id.in_(package_names_or_ids),
+                    model.Package.name.in_(package_names_or_ids))).all()
+
+    by_id = dict((row.id, row) for row in rows)
+    by_name = dict((row.name, row) for row in rows)
+
+    memo = _package_id_memo(context)
+    packages = {}
+    for value in package_names_or_ids:
+        row = by_id.get(value) or by_name.get(value)
+        if row is not None:
+            packages[value] = row
+            memo[(package_type, value)] = row.id
+    return packages
+
+
+def experience_package_list_sort(value, context):
+    '''
+    Validate and normalize a sort parameter for the experience package list,
+    e.g. 'title asc' or 'metadata_modified desc'. The order defaults to
+    'asc' if it isn't given.
+    '''
+    parts = value.split()
+    if len(parts) == 1:
+        parts.append('asc')
+    if len(parts) != 2 or parts[0] not in PACKAGE_LIST_SORT_FIELDS \
+            or parts[1] not in ('asc', 'desc'):
+        raise Invalid(_('Sort must be one of {fields}, followed by asc or '
+                        'desc').format(
+                            fields=', '.join(PACKAGE_LIST_SORT_FIELDS)))
+    return ' '.join(parts)
+
+
+def experience_list_fields(value, context):
+    '''
+    Validate a fields parameter for the experience list, either a list of
+    field names or a comma separated string, e.g. 'id,title'. Returns a list
+    of field names.
+    '''
+    if isinstance(value, basestring):
+        value = [field.strip() for field in value.split(',') if field.strip()]
+    if not isinstance(value, list) or not value:
+        raise Invalid(_('Not a list'))
+    for field in value:
+        if field not in EXPERIENCE_LIST_FIELDS:
+            raise Invalid(_('Fields must be one or more of {fields}').format(
+                fields=', '.join(EXPERIENCE_LIST_FIELDS)))
+    return value
+
+
+def experience_image_display_url(image_url):
+    '''
+    Return the URL an experience image is displayed from: image_url itself if
+    it's a full URL, otherwise the URL of the uploaded file on this site.
+
+    The URL is built as h.url_for_static(..., qualified=True) builds it, with
+    `ckan.root_path` and without a locale, but from the config alone, so it
+    also works outside of a web request, e.g. in paster commands.
+    '''
+    if image_url and not image_url.startswith('http'):
+        root_path = re.sub('/{{LANG}}', '', config.get('ckan.root_path') or '')
+        return '{site_url}{root_path}/uploads/experience/{image_url}'.format(
+            site_url=config.get('ckan.site_url', '').rstrip('/'),
+            root_path=root_path.rstrip('/'),
+            image_url=image_url)
+    return image_url
+
+
+def image_display_url_from_image_url(key, data, errors, context):
+    '''
+    Set image_display_url from image_url, so it's stored with the experience
+    rather than worked out each time it's shown. Any passed value is
+    replaced.
+    '''
+    image_url = data.get(key[:-1] + ('image_url',))
+    if not image_url or image_url is missing:
+        data.pop(key, None)
+        raise StopOnError
+    data[key] = experience_image_display_url(image_url)
+
+
+def _is_image_variant(variant):
+    '''
+    Whether variant is a resized image copy as made by images.make_variants.
+    Its filename is deleted from storage when the image changes, so it must
+    not point outside the upload directory.
+    '''
+    if not isinstance(variant, dict) or \
+            set(variant.keys()) != set(IMAGE_VARIANT_KEYS):
+        return False
+    width, filename = variant['width'], variant['filename']
+    return (isinstance(variant['url'], basestring) and
+            isinstance(width, (int, long)) and not isinstance(width, bool) and
+            width > 0 and
+            variant['type'] in IMAGE_VARIANT_TYPES and
+            isinstance(filename, basestring) and
+            filename == os.path.basename(filename) and
+            '\\' not in filename and not filename.startswith('.'))
+
+
+def image_variants_to_json(value, context):
+    '''
+    Check the list of resized image copies and serialize it to JSON, so it
+    can be stored in extras. A JSON string, as stored, is checked too.
+
+    Each copy's url is worked out again from its filename, as
+    image_display_url is from image_url, so saving an experience updates it
+    after `ckan.site_url` or `ckan.root_path` changes.
+    '''
+    if isinstance(value, basestring):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise Invalid(_('Image variants must be a list'))
+    if not isinstance(value, list):
+        raise Invalid(_('Image variants must be a list'))
+    if not all(_is_image_variant(variant) for variant in value):
+        raise Invalid(_('Image variants must each have a url, width, type '
+                        'and filename'))
+    return json.dumps([
+        dict(variant, url=experience_image_display_url(variant['filename']))
+        for variant in value])
+
+
+def image_variants_from_json(value, context):
+    '''
+    Load the list of resized image copies stored in extras.
+    '''
+    if isinstance(value, basestring):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return []
+    return value
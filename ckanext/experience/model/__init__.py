@@ -18,7 +18,11 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from sqlalchemy import Table
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import types
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy.engine import reflection
 
 from ckan.model.domain_object import DomainObject
 from ckan.model.meta import metadata, mapper, Session
@@ -32,10 +36,10 @@ experience_package_assocation_table = None
 experience_admin_table = None
 
 
-def setup():
+def setup(covering_indexes=False):
     # setup experience_package_assocation_table
     if experience_package_assocation_table is None:
-        define_experience_package_association_table()
+        define_experience_package_association_table(covering_indexes)
         log.debug('ExperiencePackageAssociation table defined in memory')
 
     if model.package_table.exists():
@@ -44,6 +48,13 @@ def setup():
             log.debug('ExperiencePackageAssociation table create')
         else:
             log.debug('ExperiencePackageAssociation table already exists')
+            missing_indexes = get_missing_indexes()
+            if missing_indexes:
+                log.warning(
+                    'Missing indexes on the experience_package_association '
+                    'table: {0}. Create them with `paster experience '
+                    'create_indexes`.'.format(
+                        ', '.join(index.name for index in missing_indexes)))
     else:
         log.debug('ExperiencePackageAssociation table creation deferred')
 
@@ -87,6 +98,20 @@ class ExperienceBaseModel(DomainObject):
         return instance.as_dict()
 
 
+def _filter_readable(q, include_private=False, organization_ids=None):
+    '''
+    Filter the package query q to the packages that can be read: all of them
+    if include_private is True, otherwise the public ones and the private
+    ones owned by the organizations in organization_ids.
+    '''
+    if include_private:
+        return q
+    if organization_ids:
+        return q.filter(or_(model.Package.private == False,
+                            model.Package.owner_org.in_(organization_ids)))
+    return q.filter(model.Package.private == False)
+
+
 class ExperiencePackageAssociation(ExperienceBaseModel):
 
     @classmethod
@@ -96,9 +121,168 @@ class ExperiencePackageAssociation(ExperienceBaseModel):
         '''
         experience_package_association_list = \
             Session.query(cls.package_id).filter_by(
-                experience_id=experience_id).all()
+                experience_id=experience_id).order_by(cls.package_id).all()
         return experience_package_association_list
 
+    @classmethod
+    def get_active_package_ids_for_experience(cls, experience_id,
+                                              include_private=False,
+                                              organization_ids=None,
+                                              limit=None, offset=0,
+                                              sort='title asc'):
+        '''
+        Return a list of the ids of the active packages associated with the
+        passed experience_id. Private packages are only included if
+        include_private is True or they belong to one of the
+        organization_ids.
+
+        Packages are ordered by sort, a package column name followed by
+        'asc' or 'desc', with the package id as a tie-breaker so that pages
+        are stable.
+        '''
+        q = Session.query(model.Package.id) \
+            .join(cls, cls.package_id == model.Package.id) \
+            .filter(cls.experience_id == experience_id) \
+            .filter(model.Package.state == 'active')
+        q = _filter_readable(q, include_private, organization_ids)
+
+        sort_field, sort_order = sort.split()
+        sort_column = getattr(model.Package, sort_field)
+        if sort_order == 'desc':
+            sort_column = sort_column.desc()
+        q = q.order_by(sort_column, model.Package.id)
+
+        if offset:
+            q = q.offset(offset)
+        if limit is not None:
+            q = q.limit(limit)
+        return [package_id for (package_id, ) in q.all()]
+
+    @classmethod
+    def count_packages_for_experience(cls, experience_id,
+                                      include_private=False,
+                                      organization_ids=None):
+        '''
+        Return the number of active packages associated with the passed
+        experience_id. Private packages are only counted if include_private
+        is True or they belong to one of the organization_ids.
+        '''
+        q = Session.query(func.count(model.Package.id)) \
+            .select_from(model.Package) \
+            .join(cls, cls.package_id == model.Package.id) \
+            .filter(cls.experience_id == experience_id) \
+            .filter(model.Package.state == 'active')
+        q = _filter_readable(q, include_private, organization_ids)
+        return q.scalar()
+
+    @classmethod
+    def count_private_packages_by_organization(cls, experience_id):
+        '''
+        Return a dict mapping the ids of organizations to the number of their
+        active, private packages associated with the passed experience_id,
+        counted in a single query.
+        '''
+        q = Session.query(model.Package.owner_org,
+                          func.count(model.Package.id)) \
+            .join(cls, cls.package_id == model.Package.id) \
+            .filter(cls.experience_id == experience_id) \
+            .filter(model.Package.state == 'active') \
+            .filter(model.Package.private == True) \
+            .group_by(model.Package.owner_org)
+        return dict((owner_org, count) for (owner_org, count) in q.all()
+                    if owner_org)
+
+    @classmethod
+    def get_linked_package_ids(cls, experience_id, package_ids):
+        '''
+        Return the set of the passed package_ids that are associated with the
+        passed experience_id, looked up in a single query.
+        '''
+        if not package_ids:
+            return set()
+        q = Session.query(cls.package_id) \
+            .filter(cls.experience_id == experience_id) \
+            .filter(cls.package_id.in_(package_ids))
+        return set(package_id for (package_id, ) in q.all())
+
+    @classmethod
+    def create_many(cls, experience_id, package_ids):
+        '''
+        Associate each of the passed package_ids with the passed
+        experience_id in a single INSERT statement. The caller is responsible
+        for committing.
+        '''
+        if not package_ids:
+            return
+        Session.execute(experience_package_assocation_table.insert(),
+                        [{'experience_id': experience_id,
+                          'package_id': package_id}
+                         for package_id in package_ids])
+
+    @classmethod
+    def delete_many(cls, experience_id, package_ids):
+        '''
+        Remove the associations between the passed experience_id and each of
+        the passed package_ids in a single DELETE statement. The caller is
+        responsible for committing.
+        '''
+        if not package_ids:
+            return
+        Session.query(cls) \
+            .filter(cls.experience_id == experience_id) \
+            .filter(cls.package_id.in_(package_ids)) \
+            .delete(synchronize_session=False)
+
+    @classmethod
+    def delete_for_experience(cls, experience_id):
+        '''
+        Remove all the associations of the passed experience_id in a single
+        DELETE statement. The caller is responsible for committing.
+        '''
+        Session.query(cls) \
+            .filter(cls.experience_id == experience_id) \
+            .delete(synchronize_session=False)
+
+    @classmethod
+    def get_active_experience_ids_for_package(cls, package_id,
+                                              include_private=False,
+                                              organization_ids=None,
+                                              limit=None, offset=0):
+        '''
+        Return a list of the ids of the active experiences associated with the
+        passed package_id, ordered by title. Private experiences are only
+        included if include_private is True or they belong to one of the
+        organization_ids.
+        '''
+        q = Session.query(model.Package.id) \
+            .join(cls, cls.experience_id == model.Package.id) \
+            .filter(cls.package_id == package_id) \
+            .filter(model.Package.state == 'active')
+        q = _filter_readable(q, include_private, organization_ids)
+        q = q.order_by(model.Package.title, model.Package.id)
+
+        if offset:
+            q = q.offset(offset)
+        if limit is not None:
+            q = q.limit(limit)
+        return [experience_id for (experience_id, ) in q.all()]
+
+    @classmethod
+    def get_experiences_not_linked_to_package(cls, package_id):
+        '''
+        Return a list of (id, title) tuples for the active experiences that
+        are not associated with the passed package_id, ordered by title.
+        '''
+        linked = Session.query(cls.experience_id) \
+            .filter(cls.experience_id == model.Package.id) \
+            .filter(cls.package_id == package_id)
+        q = Session.query(model.Package.id, model.Package.title) \
+            .filter(model.Package.type == 'experience') \
+            .filter(model.Package.state == 'active') \
+            .filter(~linked.exists()) \
+            .order_by(model.Package.title, model.Package.id)
+        return q.all()
+
     @classmethod
     def get_experience_ids_for_package(cls, package_id):
         '''
@@ -106,11 +290,11 @@ class ExperiencePackageAssociation(ExperienceBaseModel):
         '''
         experience_package_association_list = \
             Session.query(cls.experience_id).filter_by(
-                package_id=package_id).all()
+                package_id=package_id).order_by(cls.experience_id).all()
         return experience_package_association_list
 
 
-def define_experience_package_association_table():
+def define_experience_package_association_table(covering_indexes=False):
     global experience_package_assocation_table
 
     experience_package_assocation_table = Table(
@@ -127,9 +311,46 @@ def define_experience_package_association_table():
                primary_key=True, nullable=False)
     )
 
+    # The primary key leads on package_id, so lookups by experience_id need
+    # their own index. The covering index also holds package_id, so listing
+    # an experience's packages can be answered from the index alone.
+    if covering_indexes:
+        Index('idx_experience_package_association_experience_package',
+              experience_package_assocation_table.c.experience_id,
+              experience_package_assocation_table.c.package_id)
+    else:
+        Index('idx_experience_package_association_experience_id',
+              experience_package_assocation_table.c.experience_id)
+
     mapper(ExperiencePackageAssociation, experience_package_assocation_table)
 
 
+def get_missing_indexes():
+    '''
+    Return the indexes defined for the experience_package_association table
+    that don't exist in the database yet, e.g. because the table was created
+    by an older version of the extension.
+    '''
+    inspector = reflection.Inspector.from_engine(metadata.bind)
+    existing_index_names = set(
+        index['name'] for index in
+        inspector.get_indexes(experience_package_assocation_table.name))
+    return [index for index in experience_package_assocation_table.indexes
+            if index.name not in existing_index_names]
+
+
+def create_missing_indexes():
+    '''
+    Create the indexes returned by get_missing_indexes and return their
+    names.
+    '''
+    created = []
+    for index in get_missing_indexes():
+        index.create(metadata.bind)
+        created.append(index.name)
+    return created
+
+
 class ExperienceAdmin(ExperienceBaseModel):
 
     @classmethod
@@ -144,8 +365,14 @@ class ExperienceAdmin(ExperienceBaseModel):
     def is_user_experience_admin(cls, user):
         '''
         Determine whether passed user is in the experience admin list.
+
+        Looks up the user's row by primary key rather than loading the whole
+        list, so the check costs the same however many admins there are.
         '''
-        return (user.id in cls.get_experience_admin_ids())
+        if user is None:
+            return False
+        q = Session.query(cls.user_id).filter(cls.user_id == user.id)
+        return Session.query(q.exists()).scalar()
 
 
 def define_experience_admin_table():
@@ -17,7 +17,10 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
 import sys
+import json
+import hashlib
 import logging
+from collections import Counter
 
 import ckan.plugins as plugins
 import ckan.lib.plugins as lib_plugins
@@ -28,6 +31,18 @@ from ckan import model as ckan_model
 from ckan.lib.plugins import DefaultTranslation
 
 from routes.mapper import SubMapper
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import get_history
+
+try:
+    from ckan.common import config
+except ImportError:  # for ckan <= 2.5
+    from pylons import config
+
+try:
+    from ckan.lib.search.query import VALID_SOLR_PARAMETERS
+except ImportError:
+    VALID_SOLR_PARAMETERS = set()
 
 import ckanext.experience.logic.auth
 import ckanext.experience.logic.action.create
@@ -36,7 +51,12 @@ import ckanext.experience.logic.action.update
 import ckanext.experience.logic.action.get
 import ckanext.experience.logic.schema as experience_schema
 import ckanext.experience.logic.helpers as experience_helpers
+from ckanext.experience import cache as experience_cache
+from ckanext.experience import images as experience_images
+from ckanext.experience import jobs as experience_jobs
+from ckanext.experience.logic.action import get as experience_get
 from ckanext.experience.model import setup as model_setup
+from ckanext.experience.model import ExperiencePackageAssociation
 
 c = tk.c
 _ = tk._
@@ -45,6 +65,23 @@ log = logging.getLogger(__name__)
 
 DATASET_TYPE_NAME = 'experience'
 
+# Whether package_search passes `fq_list` on to Solr as separate filter
+# queries
+SEPARATE_FILTER_QUERIES = 'fq_list' in VALID_SOLR_PARAMETERS
+
+# num_datasets_sort is indexed as a string, so pad it to sort by number
+NUM_DATASETS_SORT_FORMAT = u'{0:010d}'
+
+# Key of the indexed number of private datasets in an experience per
+# organization, used to work out num_datasets for users who can read some of
+# them. Never shown.
+PRIVATE_COUNTS_KEY = u'experience_private_counts'
+
+# Number of experience dicts enriched by ExperiencePlugin._add_to_pkg_dict,
+# and of those where enrichment was skipped, by reason.
+enrichment_counts = Counter()
+
+
 def register_translator():
     # Register a translator in this thread so that
     # the _() functions in logic layer can work
@@ -69,6 +106,8 @@ class ExperiencePlugin(plugins.SingletonPlugin, lib_plugins.DefaultDatasetForm,
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IDomainObjectModification, inherit=True)
+    plugins.implements(plugins.ISession, inherit=True)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.ITranslation)
 
@@ -97,7 +136,25 @@ class ExperiencePlugin(plugins.SingletonPlugin, lib_plugins.DefaultDatasetForm,
     # IConfigurable
 
     def configure(self, config):
-        model_setup()
+        model_setup(covering_indexes=tk.asbool(
+            config.get('ckanext.experience.covering_indexes', False)))
+
+        experience_cache.num_datasets.ttl = tk.asint(
+            config.get('ckanext.experience.num_datasets_cache_ttl', 0))
+        experience_cache.site_stats.ttl = tk.asint(
+            config.get('ckanext.experience.site_stats_cache_ttl', 0))
+        experience_cache.notes_formatted.maxsize = tk.asint(
+            config.get('ckanext.experience.notes_cache_size', 1000))
+
+        experience_images.widths = [
+            tk.asint(width) for width in tk.aslist(
+                config.get('ckanext.experience.image_widths',
+                           '320 640 1280'))]
+        experience_images.workers = tk.asint(
+            config.get('ckanext.experience.image_workers', 4))
+
+        self.api_notes_formatted = tk.asbool(
+            config.get('ckanext.experience.api_notes_formatted', True))
 
     # IDatasetForm
 
@@ -137,6 +194,8 @@ class ExperiencePlugin(plugins.SingletonPlugin, lib_plugins.DefaultDatasetForm,
         return {
             'facet_remove_field': experience_helpers.facet_remove_field,
             'get_site_statistics': experience_helpers.get_site_statistics,
+            'experience_image_srcset':
+                experience_helpers.experience_image_srcset,
             'check_ckan_version': tk.check_ckan_version
         }
 
@@ -161,8 +220,14 @@ class ExperiencePlugin(plugins.SingletonPlugin, lib_plugins.DefaultDatasetForm,
                 ckanext.experience.logic.auth.package_association_create,
             'ckanext_experience_package_association_delete':
                 ckanext.experience.logic.auth.package_association_delete,
+            'ckanext_experience_package_association_bulk_create':
+                ckanext.experience.logic.auth.package_association_bulk_create,
+            'ckanext_experience_package_association_bulk_delete':
+                ckanext.experience.logic.auth.package_association_bulk_delete,
             'ckanext_experience_package_list':
                 ckanext.experience.logic.auth.experience_package_list,
+            'ckanext_experience_package_count':
+                ckanext.experience.logic.auth.experience_package_count,
             'ckanext_package_experience_list':
                 ckanext.experience.logic.auth.package_experience_list,
             'ckanext_experience_admin_add':
@@ -230,8 +295,14 @@ class ExperiencePlugin(plugins.SingletonPlugin, lib_plugins.DefaultDatasetForm,
                 ckanext.experience.logic.action.create.experience_package_association_create,
             'ckanext_experience_package_association_delete':
                 ckanext.experience.logic.action.delete.experience_package_association_delete,
+            'ckanext_experience_package_association_bulk_create':
+                ckanext.experience.logic.action.create.experience_package_association_bulk_create,
+            'ckanext_experience_package_association_bulk_delete':
+                ckanext.experience.logic.action.delete.experience_package_association_bulk_delete,
             'ckanext_experience_package_list':
                 ckanext.experience.logic.action.get.experience_package_list,
+            'ckanext_experience_package_count':
+                ckanext.experience.logic.action.get.experience_package_count,
             'ckanext_package_experience_list':
                 ckanext.experience.logic.action.get.package_experience_list,
             'ckanext_experience_admin_add':
@@ -253,32 +324,91 @@ class ExperiencePlugin(plugins.SingletonPlugin, lib_plugins.DefaultDatasetForm,
         if pkg_dict['type'] != 'experience':
             return pkg_dict
 
+        private_counts = pkg_dict.pop(PRIVATE_COUNTS_KEY, None)
+
+        # Internal callers that don't use the added keys can skip this.
+        if context.get('experience_skip_enrichment'):
+            enrichment_counts['skipped_by_context'] += 1
+            return pkg_dict
+
         # Add a display url for the Experience image to the pkg dict so template
-        # has access to it.
-        image_url = pkg_dict.get('image_url')
-        pkg_dict[u'image_display_url'] = image_url
-        if image_url and not image_url.startswith('http'):
-            pkg_dict[u'image_url'] = image_url
-            pkg_dict[u'image_display_url'] = \
-                h.url_for_static('uploads/{0}/{1}'
-                                 .format(DATASET_TYPE_NAME,
-                                         pkg_dict.get('image_url')),
-                                 qualified=True)
-
-        # Add dataset count
-        pkg_dict[u'num_datasets'] = len(
-            tk.get_action('ckanext_experience_package_list')(
-                context, {'experience_id': pkg_dict['id']}))
-
-        # Rendered notes
-        pkg_dict[u'experience_notes_formatted'] = \
-            h.render_markdown(pkg_dict['notes'])
+        # has access to it. It's stored with the experience when it's saved,
+        # so it only needs working out for experiences saved before that.
+        if not pkg_dict.get('image_display_url'):
+            image_url = pkg_dict.get('image_url')
+            pkg_dict[u'image_display_url'] = image_url
+            if image_url and not image_url.startswith('http'):
+                pkg_dict[u'image_display_url'] = \
+                    h.url_for_static('uploads/{0}/{1}'
+                                     .format(DATASET_TYPE_NAME, image_url),
+                                     qualified=True)
+
+        # Add dataset count. The search index has the count of public datasets
+        # and of private datasets per organization (see before_index), so
+        # it's only worked out if they're missing. pkg_dict['id'] is already
+        # an id, so skip the action's validation and auth.
+        organization_ids = \
+            experience_get.get_readable_organization_ids(context)
+        if u'num_datasets' not in pkg_dict or \
+                (organization_ids != [] and private_counts is None):
+            pkg_dict[u'num_datasets'] = \
+                experience_get.count_experience_datasets(context,
+                                                         pkg_dict['id'])
+        elif organization_ids is None:
+            pkg_dict[u'num_datasets'] += sum(private_counts.values())
+        elif organization_ids:
+            pkg_dict[u'num_datasets'] += sum(
+                private_counts.get(organization_id, 0)
+                for organization_id in organization_ids)
+
+        # Rendered notes, unless they came from the search index (see
+        # before_index)
+        if self._skip_notes_formatted(context):
+            pkg_dict.pop(u'experience_notes_formatted', None)
+        elif u'experience_notes_formatted' not in pkg_dict:
+            pkg_dict[u'experience_notes_formatted'] = \
+                self._render_notes(pkg_dict)
+
+        enrichment_counts['enriched'] += 1
         return pkg_dict
 
+    def _skip_notes_formatted(self, context):
+        '''
+        Whether to leave experience_notes_formatted out of the pkg_dict, either
+        because the caller asked to or because it's an API call and
+        `ckanext.experience.api_notes_formatted` is off.
+        '''
+        if context.get('experience_skip_notes_formatted'):
+            return True
+        return 'api_version' in context and \
+            not getattr(self, 'api_notes_formatted', True)
+
+    def _render_notes(self, pkg_dict):
+        '''
+        Return the notes rendered as markdown, memoized by a hash of the notes
+        and the experience's metadata_modified.
+        '''
+        notes = pkg_dict.get('notes') or u''
+        key = hashlib.sha1(u'{0}\n{1}'.format(
+            pkg_dict.get('metadata_modified'), notes).encode('utf-8')
+        ).hexdigest()
+
+        notes_formatted = experience_cache.notes_formatted.get(key)
+        if notes_formatted is None:
+            notes_formatted = h.render_markdown(pkg_dict['notes'])
+            experience_cache.notes_formatted.set(key, notes_formatted)
+        return notes_formatted
+
     def after_show(self, context, pkg_dict):
         '''
         Modify package_show pkg_dict.
         '''
+        # For views, package_show has just run before_view on this pkg_dict,
+        # which added the same keys.
+        if context.get('for_view') and u'num_datasets' in pkg_dict \
+                and pkg_dict.get('type') == DATASET_TYPE_NAME:
+            enrichment_counts['skipped_already_enriched'] += 1
+            return
         pkg_dict = self._add_to_pkg_dict(context, pkg_dict)
 
     def before_view(self, pkg_dict):
@@ -286,19 +416,185 @@ class ExperiencePlugin(plugins.SingletonPlugin, lib_plugins.DefaultDatasetForm,
         Modify pkg_dict that is sent to templates.
         '''
 
+        return self._add_to_pkg_dict(self._view_context(), pkg_dict)
+
+    def _view_context(self):
+        '''
+        Return a context for the current user. The organizations whose
+        private datasets they can read are kept on `c`, so they are looked up
+        once per request rather than once per experience shown.
+        '''
+        # anonymous users have no user name, so no user is looked up for them
         context = {'model': ckan_model, 'session': ckan_model.Session,
-                   'user': c.user or c.author}
+                   'user': c.user, 'auth_user_obj': c.userobj}
+
+        memo = getattr(c, 'experience_readable_organization_ids', None)
+        if not isinstance(memo, dict):
+            memo = {}
+            c.experience_readable_organization_ids = memo
+        if c.user not in memo:
+            memo[c.user] = \
+                experience_get.get_readable_organization_ids(context)
+        context['experience_readable_organization_ids'] = memo[c.user]
+        return context
+
+    def before_index(self, pkg_dict):
+        '''
+        Index the ids of the experiences a dataset is in, so searches can
+        filter on them, e.g. `-vocab_experiences:<experience id>`.
+
+        Index the ids and number of the active, public datasets in an
+        experience. The number is also added to the experience dict stored in
+        the index, if there is one (see `ckan.cache_validated_datasets`), so
+        search results have it without a query each, and as
+        `num_datasets_sort`, zero-padded so the string field sorts by number.
+        So is the number of active, private datasets per organization, so
+        users who can read some of them get their count without a query
+        either.
+
+        If `ckanext.experience.index_notes_formatted` is set, the rendered
+        notes are stored in the experience dict too, so search results need
+        no enrichment at all when shown.
+        '''
+        if pkg_dict.get('dataset_type') != DATASET_TYPE_NAME:
+            pkg_dict['vocab_experiences'] = [
+                experience_id for (experience_id, ) in
+                ExperiencePackageAssociation.get_experience_ids_for_package(
+                    pkg_dict['id'])]
+            return pkg_dict
+
+        dataset_ids = \
+            ExperiencePackageAssociation.get_active_package_ids_for_experience(
+                pkg_dict['id'])
+        pkg_dict['vocab_datasets'] = dataset_ids
+        pkg_dict['num_datasets_sort'] = NUM_DATASETS_SORT_FORMAT.format(
+            len(dataset_ids))
 
-        return self._add_to_pkg_dict(context, pkg_dict)
+        # not stored if `ckan.cache_validated_datasets` is off
+        if not pkg_dict.get('validated_data_dict'):
+            return pkg_dict
+        validated_data_dict = json.loads(pkg_dict['validated_data_dict'])
+        validated_data_dict[u'num_datasets'] = len(dataset_ids)
+        validated_data_dict[PRIVATE_COUNTS_KEY] = \
+            ExperiencePackageAssociation \
+            .count_private_packages_by_organization(pkg_dict['id'])
+        if tk.asbool(config.get('ckanext.experience.index_notes_formatted',
+                                 False)):
+            validated_data_dict[u'experience_notes_formatted'] = \
+                self._render_notes(validated_data_dict)
+        pkg_dict['validated_data_dict'] = json.dumps(validated_data_dict)
+        return pkg_dict
+
+    def after_search(self, search_results, search_params):
+        '''
+        Leave the indexed private dataset counts out of search results that
+        weren't shown with before_view, e.g. API calls.
+        '''
+        for pkg_dict in search_results.get('results', []):
+            pkg_dict.pop(PRIVATE_COUNTS_KEY, None)
+        return search_results
 
     def before_search(self, search_params):
         '''
         Unless the query is already being filtered by this dataset_type
         (either positively, or negatively), exclude datasets of type
         `experience`.
+
+        The exclusion is sent as a filter query of its own where CKAN
+        supports `fq_list`, so Solr caches it once for all searches rather
+        than once per distinct `fq`.
         '''
         fq = search_params.get('fq', '')
+        fq_list = search_params.get('fq_list') or []
         filter = 'dataset_type:{0}'.format(DATASET_TYPE_NAME)
-        if filter not in fq:
+        if filter in fq or any(filter in item for item in fq_list):
+            return search_params
+
+        if SEPARATE_FILTER_QUERIES:
+            search_params.update({'fq_list': list(fq_list) + ['-' + filter]})
+        else:
             search_params.update({'fq': fq + " -" + filter})
         return search_params
+
+    # ISession
+
+    def before_flush(self, session, flush_context, instances):
+        '''
+        Record the datasets whose state, private flag or organization is
+        being changed, the only changes that affect the dataset counts of
+        experiences.
+        '''
+        for obj in session.dirty:
+            if isinstance(obj, ckan_model.Package) and \
+                    obj.type != DATASET_TYPE_NAME and \
+                    any(get_history(obj, key).has_changes()
+                        for key in ('state', 'private', 'owner_org')):
+                if not hasattr(session, '_experience_count_changed_ids'):
+                    session._experience_count_changed_ids = set()
+                session._experience_count_changed_ids.add(obj.id)
+
+    def after_commit(self, session):
+        '''
+        Clear the cached dataset counts of the experiences found by notify,
+        and on CKAN >= 2.7 queue them for reindexing, now that the changes
+        are committed.
+        '''
+        experience_ids = getattr(session, '_experience_ids_to_reindex', None)
+        self._forget_changes(session)
+        if not experience_ids:
+            return
+
+        for experience_id in experience_ids:
+            experience_cache.num_datasets.invalidate(experience_id)
+
+        if tk.check_ckan_version(min_version='2.7'):
+            try:
+                tk.enqueue_job(experience_jobs.reindex_packages,
+                               [sorted(experience_ids)],
+                               title='Reindex experiences')
+            except Exception as e:
+                log.warning('Could not queue the reindexing of experiences '
+                            '{0}, their dataset counts may be out of date: '
+                            '{1}'.format(', '.join(sorted(experience_ids)), e))
+
+    def after_rollback(self, session):
+        self._forget_changes(session)
+
+    def _forget_changes(self, session):
+        for key in ('_experience_count_changed_ids',
+                    '_experience_ids_to_reindex'):
+            if hasattr(session, key):
+                delattr(session, key)
+
+    # IDomainObjectModification
+
+    def notify(self, entity, operation):
+        '''
+        When a dataset is deleted, made private or public, or moved to another
+        organization, find the experiences it's in, so their cached dataset
+        counts are cleared and they are reindexed, keeping the counts in the
+        search index right.
+
+        Before CKAN 2.7, which has no background jobs, they are reindexed
+        here, otherwise in a job queued once the changes are committed.
+        '''
+        if not isinstance(entity, ckan_model.Package) or \
+                entity.type == DATASET_TYPE_NAME:
+            return
+        session = object_session(entity)
+        if session is None or entity.id not in getattr(
+                session, '_experience_count_changed_ids', ()):
+            return
+
+        experience_ids = [
+            experience_id for (experience_id, ) in
+            ExperiencePackageAssociation.get_experience_ids_for_package(
+                entity.id)]
+        if not experience_ids:
+            return
+        if not hasattr(session, '_experience_ids_to_reindex'):
+            session._experience_ids_to_reindex = set()
+        session._experience_ids_to_reindex.update(experience_ids)
+
+        if not tk.check_ckan_version(min_version='2.7'):
+            experience_jobs.reindex_packages(experience_ids)
@@ -15,6 +15,15 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from ckan.lib.search.query import PackageSearchQuery
+
+from ckanext.experience import cache as experience_cache
 from ckanext.experience.model import setup as experience_setup
 
 
@@ -31,3 +40,53 @@ class ExperienceFunctionalTestBase(helpers.FunctionalTestBase):
         super(ExperienceFunctionalTestBase, self).setup()
         # set up experience tables
         experience_setup()
+        # don't let cached values leak between tests
+        experience_cache.num_datasets.clear()
+        experience_cache.site_stats.clear()
+        experience_cache.notes_formatted.clear()
+
+
+@contextmanager
+def count_queries():
+    '''
+    Count the database and Solr queries made inside the with block, in the
+    dict it yields, e.g.::
+
+        with count_queries() as counts:
+            app.get('/experience')
+        counts['db'], counts['solr']
+    '''
+    counts = {'db': 0, 'solr': 0}
+    run = PackageSearchQuery.__dict__['run']
+
+    def count_db_query(*args):
+        counts['db'] += 1
+
+    def count_solr_query(query, *args, **kwargs):
+        counts['solr'] += 1
+        return run(query, *args, **kwargs)
+
+    event.listen(model.meta.engine, 'before_cursor_execute', count_db_query)
+    PackageSearchQuery.run = count_solr_query
+    try:
+        yield counts
+    finally:
+        PackageSearchQuery.run = run
+        event.remove(model.meta.engine, 'before_cursor_execute',
+                     count_db_query)
+
+
+def run_queued_jobs():
+    '''
+    Run the background jobs queued so far in this process, e.g. the
+    reindexing of experiences after a dataset in them was deleted. Before
+    CKAN 2.7 there are no background jobs, and that work is done straight
+    away, so there is nothing to run.
+    '''
+    if not toolkit.check_ckan_version(min_version='2.7'):
+        return
+    from ckan.lib import jobs
+    queue = jobs.get_queue()
+    for job in queue.jobs:
+        job.perform()
+    queue.empty()
@@ -32,6 +32,7 @@ except ImportError:  # for ckan <= 2.3
     import ckan.new_tests.helpers as helpers
 
 
+from ckanext.experience.logic.validators import experience_image_display_url
 from ckanext.experience.model import ExperiencePackageAssociation, ExperienceAdmin
 from ckanext.experience.tests import ExperienceFunctionalTestBase
 
@@ -95,6 +96,92 @@ class TestCreateExperience(ExperienceFunctionalTestBase):
         nosetools.assert_equal(model.Session.query(Package)
                                .filter(Package.type == 'experience').count(), 1)
 
+    def test_experience_create_stores_image_display_url(self):
+        '''
+        Creating a experience stores the display url of its image in extras,
+        worked out from image_url.
+        '''
+        sysadmin = factories.Sysadmin()
+        context = {'user': sysadmin['name']}
+
+        helpers.call_action('ckanext_experience_create', context=context,
+                            name='my-experience',
+                            image_url='2018-experience.png',
+                            image_display_url='http://example.com/ignored.png')
+
+        experience = model.Package.get('my-experience')
+        nosetools.assert_true(
+            experience.extras['image_display_url'].endswith(
+                '/uploads/experience/2018-experience.png'))
+
+        experience_shown = helpers.call_action('package_show',
+                                               context=context,
+                                               id='my-experience')
+        nosetools.assert_equal(experience_shown['image_display_url'],
+                               experience.extras['image_display_url'])
+
+    @helpers.change_config('ckan.site_url', 'http://example.com')
+    @helpers.change_config('ckan.root_path', '/data/{{LANG}}')
+    def test_experience_create_image_display_url_root_path(self):
+        '''
+        The stored display url of an uploaded image includes
+        `ckan.root_path`, without the locale, as url_for_static's does.
+        '''
+        sysadmin = factories.Sysadmin()
+        context = {'user': sysadmin['name']}
+
+        helpers.call_action('ckanext_experience_create', context=context,
+                            name='my-experience',
+                            image_url='2018-experience.png')
+
+        experience = model.Package.get('my-experience')
+        nosetools.assert_equal(
+            experience.extras['image_display_url'],
+            'http://example.com/data/uploads/experience/2018-experience.png')
+
+    def test_experience_create_image_variants_round_trip(self):
+        '''
+        The list of resized image copies is stored in extras and shown as a
+        list again, with each url worked out from the copy's filename.
+        '''
+        sysadmin = factories.Sysadmin()
+        context = {'user': sysadmin['name']}
+        variants = [{'url': 'http://example.com/a-320w.jpg', 'width': 320,
+                     'type': 'image/jpeg', 'filename': 'a-320w.jpg'}]
+
+        helpers.call_action('package_create', context=context,
+                            type='experience', name='my-experience',
+                            image_variants=variants)
+
+        experience_shown = helpers.call_action('package_show',
+                                               context=context,
+                                               id='my-experience')
+        nosetools.assert_equal(
+            experience_shown['image_variants'],
+            [dict(variants[0],
+                  url=experience_image_display_url('a-320w.jpg'))])
+
+    def test_experience_create_bad_image_variants(self):
+        '''
+        Image variants that aren't resized image copies, e.g. with a filename
+        outside the upload directory, raise a ValidationError.
+        '''
+        sysadmin = factories.Sysadmin()
+        context = {'user': sysadmin['name']}
+        variant = {'url': 'http://example.com/a-320w.jpg', 'width': 320,
+                   'type': 'image/jpeg', 'filename': 'a-320w.jpg'}
+
+        for bad_variant in (dict(variant, filename='../../who.ini'),
+                            dict(variant, width='320'),
+                            dict(variant, type='text/html'),
+                            dict(variant, extra='value'),
+                            'a-320w.jpg'):
+            nosetools.assert_raises(toolkit.ValidationError,
+                                    helpers.call_action, 'package_create',
+                                    context=context, type='experience',
+                                    name='my-experience',
+                                    image_variants=[bad_variant])
+
 
 class TestCreateExperiencePackageAssociation(ExperienceFunctionalTestBase):
 
@@ -186,6 +273,77 @@ class TestCreateExperiencePackageAssociation(ExperienceFunctionalTestBase):
                                 context=context, package_id=package_id,
                                 experience_id=experience_id)
 
+    def test_association_create_indexes_experience_on_dataset(self):
+        '''
+        The dataset is reindexed with the experience id, so searches can
+        filter on it.
+        '''
+        sysadmin = factories.Sysadmin()
+        context = {'user': sysadmin['name']}
+        dataset = factories.Dataset()
+        experience = factories.Dataset(type='experience')
+
+        helpers.call_action('ckanext_experience_package_association_create',
+                            context=context, package_id=dataset['id'],
+                            experience_id=experience['id'])
+
+        results = helpers.call_action(
+            'package_search', context=context,
+            fq='vocab_experiences:"{0}"'.format(experience['id']))['results']
+        nosetools.assert_equal([result['id'] for result in results],
+                               [dataset['id']])
+
+
+class TestBulkCreateExperiencePackageAssociation(ExperienceFunctionalTestBase):
+
+    def test_association_bulk_create_no_package_ids(self):
+        '''
+        Calling bulk association create without package_ids raises
+        ValidationError.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+        experience_id = factories.Dataset(type='experience')['id']
+
+        context = {'user': sysadmin['name']}
+        nosetools.assert_raises(toolkit.ValidationError, helpers.call_action,
+                                'ckanext_experience_package_association_bulk_create',
+                                context=context, experience_id=experience_id)
+
+        nosetools.assert_equal(model.Session.query(ExperiencePackageAssociation).count(), 0)
+
+    def test_association_bulk_create(self):
+        '''
+        Calling bulk association create with ids and names creates the new
+        associations and skips existing associations and unknown packages.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+        package_one = factories.Dataset()
+        package_two = factories.Dataset()
+        package_three = factories.Dataset()
+        experience_id = factories.Dataset(type='experience')['id']
+
+        context = {'user': sysadmin['name']}
+        helpers.call_action('ckanext_experience_package_association_create',
+                            context=context, package_id=package_three['id'],
+                            experience_id=experience_id)
+
+        results = helpers.call_action(
+            'ckanext_experience_package_association_bulk_create',
+            context=context, experience_id=experience_id,
+            package_ids=[package_one['id'], package_two['name'],
+                         package_three['id'], 'my-bad-package-id'])
+
+        nosetools.assert_equal([(r['package_id'], r['success']) for r in results],
+                               [(package_one['id'], True),
+                                (package_two['id'], True),
+                                (package_three['id'], False),
+                                ('my-bad-package-id', False)])
+        nosetools.assert_equal(
+            ExperiencePackageAssociation.get_linked_package_ids(
+                experience_id, [package_one['id'], package_two['id'],
+                                package_three['id']]),
+            set([package_one['id'], package_two['id'], package_three['id']]))
+
 
 class TestCreateExperienceAdmin(ExperienceFunctionalTestBase):
 
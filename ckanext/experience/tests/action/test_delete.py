@@ -29,6 +29,7 @@ try:
 except ImportError:  # for ckan <= 2.3
     import ckan.new_tests.helpers as helpers
 
+from ckanext.experience import jobs
 from ckanext.experience.model import ExperiencePackageAssociation, ExperienceAdmin
 from ckanext.experience.tests import ExperienceFunctionalTestBase
 from ckan.model.package import Package
@@ -117,6 +118,115 @@ class TestDeleteExperience(ExperienceFunctionalTestBase):
 
         nosetools.assert_equal(model.Session.query(ExperiencePackageAssociation).count(), 0)
 
+    def test_experience_delete_reindexes_datasets(self):
+        '''
+        Deleting an experience removes it from the experiences its datasets
+        are indexed as being in.
+        '''
+        sysadmin = factories.Sysadmin()
+        context = {'user': sysadmin['name']}
+        experience = factories.Dataset(type='experience')
+        dataset = factories.Dataset()
+        helpers.call_action('ckanext_experience_package_association_create',
+                            context=context, package_id=dataset['id'],
+                            experience_id=experience['id'])
+
+        helpers.call_action('ckanext_experience_delete',
+                            context=context, id=experience['id'])
+
+        results = helpers.call_action(
+            'package_search', context=context,
+            fq='vocab_experiences:"{0}"'.format(experience['id']))['results']
+        nosetools.assert_equal(results, [])
+
+    @helpers.change_config('ckanext.experience.soft_delete', 'true')
+    def test_experience_soft_delete(self):
+        '''
+        With soft delete, deleting a experience marks it as deleted and
+        removes its associations. Purging deleted experiences removes it.
+        '''
+        sysadmin = factories.Sysadmin()
+        context = {'user': sysadmin['name']}
+        experience = factories.Dataset(type='experience', name='my-experience')
+        dataset = factories.Dataset(name='dataset-one')
+
+        helpers.call_action('ckanext_experience_package_association_create',
+                            context=context, package_id=dataset['id'],
+                            experience_id=experience['id'])
+
+        helpers.call_action('ckanext_experience_delete',
+                            context=context, id=experience['id'])
+
+        nosetools.assert_equal(model.Package.get(experience['id']).state,
+                               'deleted')
+        nosetools.assert_equal(model.Session.query(ExperiencePackageAssociation).count(), 0)
+        # the dataset is no longer indexed as being in the experience
+        results = helpers.call_action(
+            'package_search', context=context,
+            fq='vocab_experiences:"{0}"'.format(experience['id']))['results']
+        nosetools.assert_equal(results, [])
+
+        nosetools.assert_equal(jobs.purge_deleted_experiences(), 1)
+        nosetools.assert_equal(model.Session.query(Package)
+                               .filter(Package.type == 'experience').count(), 0)
+        # the dataset is kept
+        nosetools.assert_equal(model.Session.query(Package)
+                               .filter(Package.type == 'dataset').count(), 1)
+
+    @helpers.change_config('ckanext.experience.soft_delete', 'true')
+    def test_experience_soft_delete_is_one_transaction(self):
+        '''
+        If removing the associations fails, the experience isn't left deleted.
+        '''
+        sysadmin = factories.Sysadmin()
+        context = {'user': sysadmin['name']}
+        experience = factories.Dataset(type='experience')
+        dataset = factories.Dataset()
+        helpers.call_action('ckanext_experience_package_association_create',
+                            context=context, package_id=dataset['id'],
+                            experience_id=experience['id'])
+
+        def fail(experience_id):
+            raise RuntimeError('Could not delete associations')
+
+        delete_for_experience = \
+            ExperiencePackageAssociation.__dict__['delete_for_experience']
+        ExperiencePackageAssociation.delete_for_experience = staticmethod(fail)
+        try:
+            nosetools.assert_raises(RuntimeError, helpers.call_action,
+                                    'ckanext_experience_delete',
+                                    context=context, id=experience['id'])
+        finally:
+            ExperiencePackageAssociation.delete_for_experience = \
+                delete_for_experience
+        model.Session.rollback()
+
+        nosetools.assert_equal(model.Package.get(experience['id']).state,
+                               'active')
+        nosetools.assert_equal(
+            model.Session.query(ExperiencePackageAssociation).count(), 1)
+
+    @helpers.change_config('ckanext.experience.soft_delete', 'true')
+    def test_purge_deleted_skips_experiences_not_soft_deleted(self):
+        '''
+        Purging deleted experiences leaves experiences deleted with
+        package_delete in the trash.
+        '''
+        sysadmin = factories.Sysadmin()
+        context = {'user': sysadmin['name']}
+        experience_one = factories.Dataset(type='experience')
+        experience_two = factories.Dataset(type='experience')
+
+        helpers.call_action('ckanext_experience_delete',
+                            context=context, id=experience_one['id'])
+        helpers.call_action('package_delete',
+                            context=context, id=experience_two['id'])
+
+        nosetools.assert_equal(jobs.purge_deleted_experiences(), 1)
+        nosetools.assert_equal(model.Package.get(experience_one['id']), None)
+        nosetools.assert_equal(model.Package.get(experience_two['id']).state,
+                               'deleted')
+
 
 class TestDeletePackage(ExperienceFunctionalTestBase):
 
@@ -282,6 +392,38 @@ class TestDeleteExperiencePackageAssociation(ExperienceFunctionalTestBase):
                                .filter(Package.type == 'experience').count(), 1)
 
 
+class TestBulkDeleteExperiencePackageAssociation(ExperienceFunctionalTestBase):
+
+    def test_association_bulk_delete(self):
+        '''
+        Calling bulk association delete removes the listed associations and
+        skips packages that aren't in the experience.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+        package_one = factories.Dataset()
+        package_two = factories.Dataset()
+        package_three = factories.Dataset()
+        experience_id = factories.Dataset(type='experience')['id']
+
+        context = {'user': sysadmin['name']}
+        helpers.call_action('ckanext_experience_package_association_bulk_create',
+                            context=context, experience_id=experience_id,
+                            package_ids=[package_one['id'], package_two['id']])
+
+        results = helpers.call_action(
+            'ckanext_experience_package_association_bulk_delete',
+            context=context, experience_id=experience_id,
+            package_ids=[package_one['name'], package_three['id']])
+
+        nosetools.assert_equal([(r['package_id'], r['success']) for r in results],
+                               [(package_one['id'], True),
+                                (package_three['id'], False)])
+        # only the association with package_two is left
+        nosetools.assert_equal(model.Session.query(ExperiencePackageAssociation).count(), 1)
+        nosetools.assert_equal(model.Session.query(ExperiencePackageAssociation)
+                               .first().package_id, package_two['id'])
+
+
 class TestRemoveExperienceAdmin(ExperienceFunctionalTestBase):
 
     def test_experience_admin_remove_deletes_experience_admin_user(self):
@@ -15,6 +15,8 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import json
+
 from nose import tools as nosetools
 from nose import SkipTest
 
@@ -29,7 +31,13 @@ try:
 except ImportError:  # for ckan <= 2.3
     import ckan.new_tests.helpers as helpers
 
-from ckanext.experience.tests import ExperienceFunctionalTestBase
+from ckanext.experience import cache as experience_cache
+from ckanext.experience import plugin as experience_plugin
+from ckanext.experience.tests import ExperienceFunctionalTestBase, \
+    count_queries, run_queued_jobs
+
+import logging
+log = logging.getLogger(__name__)
 
 
 class TestExperienceShow(ExperienceFunctionalTestBase):
@@ -81,6 +89,85 @@ class TestExperienceShow(ExperienceFunctionalTestBase):
         nosetools.assert_true('num_datasets' in experience_shown)
         nosetools.assert_equal(experience_shown['num_datasets'], 0)
 
+    def test_experience_show_notes_formatted(self):
+        '''
+        experience_notes_formatted property is the rendered notes, also when
+        it comes from the cache.
+        '''
+        my_experience = factories.Dataset(type='experience', name='my-experience',
+                                          notes='Some **bold** notes')
+
+        for i in range(2):
+            experience_shown = helpers.call_action('ckanext_experience_show',
+                                                   id=my_experience['name'])
+            nosetools.assert_true('<strong>bold</strong>' in
+                                  experience_shown['experience_notes_formatted'])
+
+    def test_experience_show_notes_formatted_skipped(self):
+        '''
+        experience_notes_formatted property isn't added when the context asks
+        to skip it.
+        '''
+        my_experience = factories.Dataset(type='experience', name='my-experience',
+                                          notes='Some **bold** notes')
+
+        experience_shown = helpers.call_action(
+            'ckanext_experience_show',
+            context={'experience_skip_notes_formatted': True},
+            id=my_experience['name'])
+
+        nosetools.assert_false('experience_notes_formatted' in experience_shown)
+
+    def test_experience_show_notes_formatted_skipped_by_parameter(self):
+        '''
+        experience_notes_formatted property isn't added when the API call
+        passes notes_formatted=false.
+        '''
+        factories.Dataset(type='experience', name='my-experience',
+                          notes='Some **bold** notes')
+        app = self._get_test_app()
+
+        response = app.get('/api/3/action/ckanext_experience_show'
+                           '?id=my-experience&notes_formatted=false',
+                           status=200)
+
+        json_response = json.loads(response.body)
+        nosetools.assert_false('experience_notes_formatted' in
+                               json_response['result'])
+
+    def test_experience_show_for_view_enriched_once(self):
+        '''
+        The package_show for the experience page adds the experience keys
+        once, in before_view, and after_show doesn't add them again.
+        '''
+        app = self._get_test_app()
+        factories.Dataset(type='experience', name='my-experience')
+
+        enriched = experience_plugin.enrichment_counts['enriched']
+        skipped = experience_plugin.enrichment_counts['skipped_already_enriched']
+
+        app.get('/experience/my-experience', status=200)
+
+        nosetools.assert_equal(experience_plugin.enrichment_counts['enriched'],
+                               enriched + 1)
+        nosetools.assert_equal(
+            experience_plugin.enrichment_counts['skipped_already_enriched'],
+            skipped + 1)
+
+    def test_experience_show_enrichment_skipped(self):
+        '''
+        num_datasets property isn't added when the context asks to skip
+        enrichment.
+        '''
+        my_experience = factories.Dataset(type='experience', name='my-experience')
+
+        experience_shown = helpers.call_action(
+            'ckanext_experience_show',
+            context={'experience_skip_enrichment': True},
+            id=my_experience['name'])
+
+        nosetools.assert_false('num_datasets' in experience_shown)
+
     def test_experience_show_num_datasets_correct_value(self):
         '''
         num_datasets property has correct value.
@@ -131,12 +218,51 @@ class TestExperienceShow(ExperienceFunctionalTestBase):
 
         # delete the first package
         helpers.call_action('package_delete', context=context, id=package_one['id'])
+        # reindexes the experience with its new count
+        run_queued_jobs()
 
         experience_shown = helpers.call_action('ckanext_experience_show', id=my_experience['name'])
 
         # the num_datasets should only include active datasets
         nosetools.assert_equal(experience_shown['num_datasets'], 2)
 
+    def test_experience_show_num_datasets_private_datasets_for_members(self):
+        '''
+        The indexed num_datasets counts public datasets. Members of a private
+        dataset's organization get a count that includes it, and making a
+        dataset private updates the indexed count.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+        member = factories.User()
+        org = factories.Organization(users=[{'name': member['name'],
+                                             'capacity': 'member'}])
+
+        my_experience = factories.Dataset(type='experience', name='my-experience')
+        package_one = factories.Dataset()
+        package_two = factories.Dataset(owner_org=org['id'])
+
+        context = {'user': sysadmin['name']}
+        for package in (package_one, package_two):
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=my_experience['id'])
+        helpers.call_action('package_patch', context=context,
+                            id=package_two['id'], private=True)
+        run_queued_jobs()
+
+        anon_shown = helpers.call_action('package_show', context={'user': ''},
+                                         id=my_experience['id'])
+        member_shown = helpers.call_action('package_show',
+                                           context={'user': member['name']},
+                                           id=my_experience['id'])
+        search_results = helpers.call_action(
+            'package_search', context={'user': ''},
+            fq='dataset_type:experience')['results']
+
+        nosetools.assert_equal(anon_shown['num_datasets'], 1)
+        nosetools.assert_equal(member_shown['num_datasets'], 2)
+        nosetools.assert_equal(search_results[0]['num_datasets'], 1)
+
     def test_experience_anon_user_can_see_package_list_when_experience_association_was_deleted(self):
         '''
         When a experience is deleted, the remaining associations with formerly associated
@@ -220,6 +346,48 @@ class TestExperienceList(ExperienceFunctionalTestBase):
         nosetools.assert_true((dataset_one['name'], dataset_one['id']) not in experience_list_name_id)
         nosetools.assert_true((dataset_two['name'], dataset_two['id']) not in experience_list_name_id)
 
+    def test_experience_list_fields(self):
+        '''
+        Experience list action only returns the requested fields when fields
+        is passed.
+        '''
+        experience_one = factories.Dataset(type='experience')
+
+        experience_list = helpers.call_action('ckanext_experience_list',
+                                              fields=['id', 'title'])
+
+        nosetools.assert_equal(experience_list,
+                               [{'id': experience_one['id'],
+                                 'title': experience_one['title']}])
+
+    def test_experience_list_bad_fields(self):
+        '''
+        Calling experience list action with a field that can't be projected
+        raises a ValidationError.
+        '''
+        nosetools.assert_raises(toolkit.ValidationError,
+                                helpers.call_action,
+                                'ckanext_experience_list',
+                                fields=['notes'])
+
+    def test_experience_list_keyset_pages(self):
+        '''
+        Experience list action pages through experiences by name with limit
+        and cursor.
+        '''
+        for name in ['exp-c', 'exp-a', 'exp-d', 'exp-b']:
+            factories.Dataset(type='experience', name=name)
+
+        first_page = helpers.call_action('ckanext_experience_list',
+                                         fields=['name'], limit=3)
+        second_page = helpers.call_action('ckanext_experience_list',
+                                          fields=['name'], limit=3,
+                                          cursor=first_page[-1]['name'])
+
+        nosetools.assert_equal([e['name'] for e in first_page],
+                               ['exp-a', 'exp-b', 'exp-c'])
+        nosetools.assert_equal([e['name'] for e in second_page], ['exp-d'])
+
 
 class TestExperiencePackageList(ExperienceFunctionalTestBase):
 
@@ -370,6 +538,389 @@ class TestExperiencePackageList(ExperienceFunctionalTestBase):
                                 'ckanext_experience_package_list',
                                 experience_id=package['id'])
 
+    def test_experience_package_list_same_shape_as_package_show(self):
+        '''
+        Package dicts returned by ckanext_experience_package_list have the
+        same keys as those returned by package_show.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+
+        package = factories.Dataset()
+        experience_id = factories.Dataset(type='experience')['id']
+        context = {'user': sysadmin['name']}
+        helpers.call_action('ckanext_experience_package_association_create',
+                            context=context, package_id=package['id'],
+                            experience_id=experience_id)
+
+        pkg_list = helpers.call_action('ckanext_experience_package_list',
+                                       experience_id=experience_id)
+        pkg_shown = helpers.call_action('package_show', id=package['id'])
+
+        nosetools.assert_equal(sorted(pkg_list[0].keys()),
+                               sorted(pkg_shown.keys()))
+
+    def test_experience_package_list_private_datasets_not_listed_for_anon(self):
+        '''
+        Calling ckanext_experience_package_list as an anonymous user doesn't
+        return private datasets.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+        org = factories.Organization()
+
+        package_one = factories.Dataset()
+        package_two = factories.Dataset(owner_org=org['id'], private=True)
+        experience_id = factories.Dataset(type='experience')['id']
+        context = {'user': sysadmin['name']}
+        for package in (package_one, package_two):
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=experience_id)
+
+        pkg_list = helpers.call_action('ckanext_experience_package_list',
+                                       context={'user': ''},
+                                       experience_id=experience_id)
+
+        nosetools.assert_equal([pkg['id'] for pkg in pkg_list],
+                               [package_one['id']])
+
+    def test_experience_package_list_private_datasets_listed_for_members(self):
+        '''
+        Calling ckanext_experience_package_list as a member of the private
+        dataset's organization returns it, and the count agrees.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+        member = factories.User()
+        org = factories.Organization(users=[{'name': member['name'],
+                                             'capacity': 'member'}])
+
+        package_one = factories.Dataset(title='Alpha')
+        package_two = factories.Dataset(title='Bravo', owner_org=org['id'],
+                                        private=True)
+        experience_id = factories.Dataset(type='experience')['id']
+        context = {'user': sysadmin['name']}
+        for package in (package_one, package_two):
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=experience_id)
+
+        pkg_list = helpers.call_action('ckanext_experience_package_list',
+                                       context={'user': member['name']},
+                                       experience_id=experience_id)
+        count = helpers.call_action('ckanext_experience_package_count',
+                                    context={'user': member['name']},
+                                    experience_id=experience_id)
+
+        nosetools.assert_equal([pkg['id'] for pkg in pkg_list],
+                               [package_one['id'], package_two['id']])
+        nosetools.assert_equal(count, len(pkg_list))
+
+    def test_experience_package_list_paged_by_title(self):
+        '''
+        Calling ckanext_experience_package_list with limit and offset returns
+        pages of packages ordered by title.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+
+        experience_id = factories.Dataset(type='experience')['id']
+        context = {'user': sysadmin['name']}
+        for title in ('Charlie', 'Alpha', 'Bravo'):
+            package = factories.Dataset(title=title)
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=experience_id)
+
+        first_page = helpers.call_action('ckanext_experience_package_list',
+                                         experience_id=experience_id,
+                                         limit=2, offset=0)
+        second_page = helpers.call_action('ckanext_experience_package_list',
+                                          experience_id=experience_id,
+                                          limit=2, offset=2)
+        reversed_list = helpers.call_action('ckanext_experience_package_list',
+                                            experience_id=experience_id,
+                                            sort='title desc')
+
+        nosetools.assert_equal([pkg['title'] for pkg in first_page],
+                               ['Alpha', 'Bravo'])
+        nosetools.assert_equal([pkg['title'] for pkg in second_page],
+                               ['Charlie'])
+        nosetools.assert_equal([pkg['title'] for pkg in reversed_list],
+                               ['Charlie', 'Bravo', 'Alpha'])
+
+    def test_experience_package_list_bad_sort(self):
+        '''
+        Calling ckanext_experience_package_list with an unsupported sort
+        raises a ValidationError.
+        '''
+        experience_id = factories.Dataset(type='experience')['id']
+
+        nosetools.assert_raises(toolkit.ValidationError, helpers.call_action,
+                                'ckanext_experience_package_list',
+                                experience_id=experience_id,
+                                sort='notes asc')
+
+
+class TestExperiencePackageListBenchmark(ExperienceFunctionalTestBase):
+
+    '''Query count benchmark for ckanext_experience_package_list'''
+
+    # number of datasets associated with the benchmarked experience
+    num_datasets = 50
+
+    def _count_queries(self, experience_id):
+        '''
+        List the datasets of the experience and return them with the number
+        of database and Solr queries made.
+        '''
+        with count_queries() as counts:
+            pkg_list = helpers.call_action('ckanext_experience_package_list',
+                                           experience_id=experience_id)
+        return pkg_list, counts
+
+    def test_experience_package_list_queries(self):
+        '''
+        Listing the datasets of an experience with many associations makes
+        one Solr query and no more database queries than listing a single
+        dataset.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+        context = {'user': sysadmin['name']}
+
+        experience_id = factories.Dataset(type='experience')['id']
+        package = factories.Dataset()
+        helpers.call_action('ckanext_experience_package_association_create',
+                            context=context, package_id=package['id'],
+                            experience_id=experience_id)
+        pkg_list, single = self._count_queries(experience_id)
+        nosetools.assert_equal(len(pkg_list), 1)
+
+        for i in xrange(self.num_datasets - 1):
+            package = factories.Dataset()
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=experience_id)
+        pkg_list, many = self._count_queries(experience_id)
+
+        log.info('ckanext_experience_package_list: %d database queries for %d '
+                 'datasets, %d for 1', many['db'], len(pkg_list), single['db'])
+
+        nosetools.assert_equal(len(pkg_list), self.num_datasets)
+        nosetools.assert_equal(many['solr'], 1)
+        nosetools.assert_equal(many['db'], single['db'])
+
+
+class TestExperiencePackageCount(ExperienceFunctionalTestBase):
+
+    '''Tests for ckanext_experience_package_count'''
+
+    def test_experience_package_count_no_packages(self):
+        '''
+        Calling ckanext_experience_package_count with a experience that has no
+        packages returns 0.
+        '''
+        experience_id = factories.Dataset(type='experience')['id']
+
+        count = helpers.call_action('ckanext_experience_package_count',
+                                    experience_id=experience_id)
+
+        nosetools.assert_equal(count, 0)
+
+    def test_experience_package_count_only_counts_active_public_datasets(self):
+        '''
+        Deleted datasets are never counted, private datasets aren't counted
+        for anonymous users.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+        org = factories.Organization()
+
+        package_one = factories.Dataset()
+        package_two = factories.Dataset()
+        package_three = factories.Dataset(owner_org=org['id'], private=True)
+        experience_id = factories.Dataset(type='experience')['id']
+        context = {'user': sysadmin['name']}
+        for package in (package_one, package_two, package_three):
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=experience_id)
+
+        helpers.call_action('package_delete', context=context,
+                            id=package_one['id'])
+
+        nosetools.assert_equal(
+            helpers.call_action('ckanext_experience_package_count',
+                                context={'user': ''},
+                                experience_id=experience_id), 1)
+        nosetools.assert_equal(
+            helpers.call_action('ckanext_experience_package_count',
+                                context={'user': sysadmin['name']},
+                                experience_id=experience_id), 2)
+
+    def test_experience_package_count_cache_invalidated_by_associations(self):
+        '''
+        A cached count is invalidated when an association is created or
+        deleted.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+
+        package = factories.Dataset()
+        experience_id = factories.Dataset(type='experience')['id']
+        context = {'user': sysadmin['name']}
+
+        experience_cache.num_datasets.ttl = 60
+        try:
+            nosetools.assert_equal(
+                helpers.call_action('ckanext_experience_package_count',
+                                    experience_id=experience_id), 0)
+
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=experience_id)
+            nosetools.assert_equal(
+                helpers.call_action('ckanext_experience_package_count',
+                                    experience_id=experience_id), 1)
+
+            helpers.call_action('ckanext_experience_package_association_delete',
+                                context=context, package_id=package['id'],
+                                experience_id=experience_id)
+            nosetools.assert_equal(
+                helpers.call_action('ckanext_experience_package_count',
+                                    experience_id=experience_id), 0)
+        finally:
+            experience_cache.num_datasets.ttl = 0
+            experience_cache.num_datasets.clear()
+
+    def test_experience_package_count_private_datasets_counted_for_members(self):
+        '''
+        Private datasets are counted for members of their organization, not
+        for other users.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+        member = factories.User()
+        other_user = factories.User()
+        org = factories.Organization(users=[{'name': member['name'],
+                                             'capacity': 'member'}])
+
+        package_one = factories.Dataset()
+        package_two = factories.Dataset(owner_org=org['id'], private=True)
+        experience_id = factories.Dataset(type='experience')['id']
+        context = {'user': sysadmin['name']}
+        for package in (package_one, package_two):
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=experience_id)
+
+        nosetools.assert_equal(
+            helpers.call_action('ckanext_experience_package_count',
+                                context={'user': member['name']},
+                                experience_id=experience_id), 2)
+        nosetools.assert_equal(
+            helpers.call_action('ckanext_experience_package_count',
+                                context={'user': other_user['name']},
+                                experience_id=experience_id), 1)
+
+    def test_experience_package_count_cache_invalidated_by_dataset_changes(self):
+        '''
+        A cached count is invalidated when a dataset in the experience is
+        made private or deleted.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+        org = factories.Organization()
+
+        package_one = factories.Dataset(owner_org=org['id'])
+        package_two = factories.Dataset()
+        experience_id = factories.Dataset(type='experience')['id']
+        context = {'user': sysadmin['name']}
+        for package in (package_one, package_two):
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=experience_id)
+
+        experience_cache.num_datasets.ttl = 60
+        try:
+            nosetools.assert_equal(
+                helpers.call_action('ckanext_experience_package_count',
+                                    experience_id=experience_id), 2)
+
+            helpers.call_action('package_patch', context=context,
+                                id=package_one['id'], private=True)
+            nosetools.assert_equal(
+                helpers.call_action('ckanext_experience_package_count',
+                                    experience_id=experience_id), 1)
+
+            helpers.call_action('package_delete', context=context,
+                                id=package_two['id'])
+            nosetools.assert_equal(
+                helpers.call_action('ckanext_experience_package_count',
+                                    experience_id=experience_id), 0)
+        finally:
+            experience_cache.num_datasets.ttl = 0
+            experience_cache.num_datasets.clear()
+
+    def test_experience_package_count_cache_kept_on_other_dataset_changes(self):
+        '''
+        A cached count is only invalidated by changes to a dataset that can
+        change it, i.e. to its state or private flag, not e.g. its title.
+        '''
+        sysadmin = factories.User(sysadmin=True)
+        org = factories.Organization()
+
+        package = factories.Dataset(owner_org=org['id'])
+        experience_id = factories.Dataset(type='experience')['id']
+        context = {'user': sysadmin['name']}
+        helpers.call_action('ckanext_experience_package_association_create',
+                            context=context, package_id=package['id'],
+                            experience_id=experience_id)
+
+        experience_cache.num_datasets.ttl = 60
+        try:
+            # a cached count that no dataset change would work out
+            experience_cache.num_datasets.set(experience_id, 5)
+
+            helpers.call_action('package_patch', context=context,
+                                id=package['id'], title='New title')
+            nosetools.assert_equal(
+                helpers.call_action('ckanext_experience_package_count',
+                                    experience_id=experience_id), 5)
+
+            helpers.call_action('package_patch', context=context,
+                                id=package['id'], private=True)
+            nosetools.assert_equal(
+                helpers.call_action('ckanext_experience_package_count',
+                                    experience_id=experience_id), 0)
+        finally:
+            experience_cache.num_datasets.ttl = 0
+            experience_cache.num_datasets.clear()
+
+    def test_experience_package_count_cache_shared(self):
+        '''
+        On CKAN >= 2.7 a cached count is kept in Redis, so other worker
+        processes see it, and see it cleared when an association is created.
+        '''
+        if not toolkit.check_ckan_version(min_version='2.7'):
+            raise SkipTest('Redis is only used on CKAN >= 2.7')
+
+        sysadmin = factories.User(sysadmin=True)
+        package = factories.Dataset()
+        experience_id = factories.Dataset(type='experience')['id']
+
+        # stands in for the cache of another worker process
+        other_worker_cache = experience_cache.SharedTTLCache('num_datasets',
+                                                             ttl=60)
+        experience_cache.num_datasets.ttl = 60
+        try:
+            helpers.call_action('ckanext_experience_package_count',
+                                experience_id=experience_id)
+            nosetools.assert_equal(other_worker_cache.get(experience_id), 0)
+
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context={'user': sysadmin['name']},
+                                package_id=package['id'],
+                                experience_id=experience_id)
+            nosetools.assert_equal(other_worker_cache.get(experience_id),
+                                   None)
+        finally:
+            experience_cache.num_datasets.ttl = 0
+            experience_cache.num_datasets.clear()
+
 
 class TestPackageExperienceList(ExperienceFunctionalTestBase):
 
@@ -481,6 +1032,85 @@ class TestPackageExperienceList(ExperienceFunctionalTestBase):
                                 'ckanext_package_experience_list',
                                 package_id=experience['id'])
 
+    def test_package_experience_list_only_active_experiences(self):
+        '''
+        Calling ckanext_package_experience_list doesn't list deleted
+        experiences.
+        '''
+        sysadmin = factories.Sysadmin()
+        package = factories.Dataset()
+        experience_one = factories.Dataset(type='experience')
+        experience_two = factories.Dataset(type='experience')
+
+        context = {'user': sysadmin['name']}
+        for experience in [experience_one, experience_two]:
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=experience['id'])
+        helpers.call_action('package_delete', context=context,
+                            id=experience_two['id'])
+
+        experience_list = helpers.call_action('ckanext_package_experience_list',
+                                              package_id=package['id'])
+
+        nosetools.assert_equal([e['id'] for e in experience_list],
+                               [experience_one['id']])
+
+    def test_package_experience_list_paged_by_title(self):
+        '''
+        Calling ckanext_package_experience_list with limit and offset returns
+        a page of experiences ordered by title.
+        '''
+        sysadmin = factories.Sysadmin()
+        package = factories.Dataset()
+
+        context = {'user': sysadmin['name']}
+        for title in ['C', 'A', 'B']:
+            experience = factories.Dataset(type='experience', title=title)
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=experience['id'])
+
+        experience_list = helpers.call_action('ckanext_package_experience_list',
+                                              package_id=package['id'],
+                                              limit=2, offset=1)
+
+        nosetools.assert_equal([e['title'] for e in experience_list],
+                               ['B', 'C'])
+
+    def test_package_experience_list_private_experiences_for_members(self):
+        '''
+        Private experiences are listed for members of their organization, not
+        for other users.
+        '''
+        sysadmin = factories.Sysadmin()
+        member = factories.User()
+        other_user = factories.User()
+        org = factories.Organization(users=[{'name': member['name'],
+                                             'capacity': 'member'}])
+        package = factories.Dataset()
+
+        context = {'user': sysadmin['name']}
+        experience_one = factories.Dataset(type='experience', title='A')
+        experience_two = factories.Dataset(type='experience', title='B',
+                                           owner_org=org['id'], private=True)
+        for experience in (experience_one, experience_two):
+            helpers.call_action('ckanext_experience_package_association_create',
+                                context=context, package_id=package['id'],
+                                experience_id=experience['id'])
+
+        member_list = helpers.call_action('ckanext_package_experience_list',
+                                          context={'user': member['name']},
+                                          package_id=package['id'])
+        other_list = helpers.call_action('ckanext_package_experience_list',
+                                         context={'user': other_user['name']},
+                                         package_id=package['id'])
+
+        nosetools.assert_equal([e['id'] for e in member_list],
+                               [experience_one['id'], experience_two['id']])
+        nosetools.assert_equal([e['id'] for e in other_list],
+                               [experience_one['id']])
+
 
 class TestExperienceAdminList(ExperienceFunctionalTestBase):
 
@@ -583,6 +1213,61 @@ class TestPackageSearchBeforeSearch(ExperienceFunctionalTestBase):
         nosetools.assert_true('custom' not in types)
         nosetools.assert_true('dataset' not in types)
 
+    def test_package_search_experiences_by_num_datasets(self):
+        '''
+        Experiences are indexed with their number of datasets, which search
+        results include and can be sorted by.
+        '''
+        sysadmin = factories.Sysadmin()
+        datasets = [factories.Dataset() for i in range(3)]
+        experience_one = factories.Dataset(type='experience')
+        experience_two = factories.Dataset(type='experience')
+
+        context = {'user': sysadmin['name']}
+        helpers.call_action(
+            'ckanext_experience_package_association_bulk_create',
+            context=context, experience_id=experience_one['id'],
+            package_ids=[dataset['id'] for dataset in datasets])
+
+        search_results = helpers.call_action(
+            'package_search', context={}, fq='dataset_type:experience',
+            sort='num_datasets_sort desc')['results']
+
+        nosetools.assert_equal(
+            [(result['id'], result['num_datasets'])
+             for result in search_results],
+            [(experience_one['id'], 3), (experience_two['id'], 0)])
+
+    @helpers.change_config('ckan.cache_validated_datasets', False)
+    def test_package_search_experiences_without_validated_data_dict(self):
+        '''
+        With ckan.cache_validated_datasets off, experiences are still indexed
+        with their datasets and number of datasets.
+        '''
+        sysadmin = factories.Sysadmin()
+        datasets = [factories.Dataset() for i in range(3)]
+        experience_one = factories.Dataset(type='experience')
+        experience_two = factories.Dataset(type='experience')
+
+        context = {'user': sysadmin['name']}
+        helpers.call_action(
+            'ckanext_experience_package_association_bulk_create',
+            context=context, experience_id=experience_one['id'],
+            package_ids=[dataset['id'] for dataset in datasets])
+
+        search_results = helpers.call_action(
+            'package_search', context={}, fq='dataset_type:experience',
+            sort='num_datasets_sort desc', use_default_schema=True)['results']
+        nosetools.assert_equal(
+            [result['id'] for result in search_results],
+            [experience_one['id'], experience_two['id']])
+
+        count = helpers.call_action(
+            'package_search', context={},
+            fq='+dataset_type:experience +vocab_datasets:"{0}"'.format(
+                datasets[0]['id']))['count']
+        nosetools.assert_equal(count, 1)
+
 
 class TestUserShowBeforeSearch(ExperienceFunctionalTestBase):
 
@@ -0,0 +1,75 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from nose import tools as nosetools
+
+from ckanext.experience import cache as experience_cache
+
+
+class FailingRedis(object):
+
+    '''A Redis connection whose commands fail, counting the attempts'''
+
+    def __init__(self):
+        self.attempts = 0
+
+    def _fail(self, *args, **kwargs):
+        self.attempts += 1
+        raise IOError('Connection refused')
+
+    get = set = delete = scan_iter = _fail
+
+
+class TestSharedTTLCache(object):
+
+    def setup(self):
+        self.redis = FailingRedis()
+        self._connect_to_redis = experience_cache.connect_to_redis
+        experience_cache.connect_to_redis = lambda: self.redis
+        experience_cache.SharedTTLCache._redis_down_until = 0
+
+    def teardown(self):
+        experience_cache.connect_to_redis = self._connect_to_redis
+        experience_cache.SharedTTLCache._redis_down_until = 0
+
+    def test_local_cache_used_when_redis_fails(self):
+        '''
+        Values are kept in the process-local cache while Redis is down.
+        '''
+        cache = experience_cache.SharedTTLCache('test', ttl=60)
+
+        cache.set('key', 1)
+        nosetools.assert_equal(cache.get('key'), 1)
+
+    def test_redis_not_retried_until_retry_after(self):
+        '''
+        After Redis fails, it isn't tried again until retry_after seconds
+        have passed, by this or any other SharedTTLCache.
+        '''
+        cache = experience_cache.SharedTTLCache('test', ttl=60)
+        other_cache = experience_cache.SharedTTLCache('other', ttl=60)
+
+        cache.get('key')
+        cache.set('key', 1)
+        other_cache.get('key')
+        other_cache.invalidate('key')
+        nosetools.assert_equal(self.redis.attempts, 1)
+
+        # retry_after seconds later
+        experience_cache.SharedTTLCache._redis_down_until = 1
+        cache.get('key')
+        nosetools.assert_equal(self.redis.attempts, 2)
@@ -0,0 +1,98 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+
+from nose import tools as nosetools
+
+import ckan.model as model
+try:
+    import ckan.tests.factories as factories
+except ImportError:  # for ckan <= 2.3
+    import ckan.new_tests.factories as factories
+
+try:
+    import ckan.tests.helpers as helpers
+except ImportError:  # for ckan <= 2.3
+    import ckan.new_tests.helpers as helpers
+
+from ckanext.experience.commands.migrate import MigrationCommand
+from ckanext.experience.logic.validators import experience_image_display_url
+from ckanext.experience.tests import ExperienceFunctionalTestBase
+
+
+class TestBackfillImageUrls(ExperienceFunctionalTestBase):
+
+    '''Tests for `paster experience backfill_image_urls`'''
+
+    def test_backfill_image_urls(self):
+        '''
+        Experiences saved without a stored image display url get one, worked
+        out from their image_url. Experiences without an image are left
+        alone.
+        '''
+        sysadmin = factories.Sysadmin()
+        context = {'user': sysadmin['name']}
+        helpers.call_action('ckanext_experience_create', context=context,
+                            name='with-image',
+                            image_url='2018-experience.png')
+        helpers.call_action('ckanext_experience_create', context=context,
+                            name='without-image')
+        # as saved by an older version of the extension
+        model.Session.query(model.PackageExtra) \
+            .filter(model.PackageExtra.key == 'image_display_url') \
+            .delete(synchronize_session=False)
+        model.Session.commit()
+
+        MigrationCommand('experience').backfill_image_urls()
+
+        with_image = model.Package.get('with-image')
+        nosetools.assert_true(
+            with_image.extras['image_display_url'].endswith(
+                '/uploads/experience/2018-experience.png'))
+        without_image = model.Package.get('without-image')
+        nosetools.assert_true('image_display_url' not in without_image.extras)
+
+    def test_backfill_image_urls_updates_variant_urls(self):
+        '''
+        The URLs of the resized image copies are worked out again from their
+        filenames, e.g. after ckan.site_url changed.
+        '''
+        sysadmin = factories.Sysadmin()
+        variant = {'url': 'http://old.example.com/uploads/experience/'
+                          '2018-experience-320w.webp',
+                   'width': 320, 'type': 'image/webp',
+                   'filename': '2018-experience-320w.webp'}
+        helpers.call_action('package_create',
+                            context={'user': sysadmin['name']},
+                            type='experience', name='with-image',
+                            image_url='2018-experience.png',
+                            image_variants=[dict(variant)])
+        # as saved before ckan.site_url changed
+        model.Session.query(model.PackageExtra) \
+            .filter(model.PackageExtra.key == 'image_variants') \
+            .update({'value': json.dumps([variant])},
+                    synchronize_session=False)
+        model.Session.commit()
+
+        MigrationCommand('experience').backfill_image_urls()
+
+        variants = json.loads(
+            model.Package.get('with-image').extras['image_variants'])
+        nosetools.assert_equal(
+            variants[0]['url'],
+            experience_image_display_url('2018-experience-320w.webp'))
@@ -30,6 +30,9 @@ except ImportError:  # for ckan <= 2.3
     import ckan.new_tests.helpers as helpers
 
 from ckanext.experience.logic.converters import convert_package_name_or_id_to_title_or_name
+from ckanext.experience.logic.validators import (
+    convert_package_name_or_id_to_id_for_type,
+    get_packages_for_names_or_ids)
 from ckanext.experience.tests import ExperienceFunctionalTestBase
 
 
@@ -84,3 +87,56 @@ class TestNameOrIdToTitleConverter(ExperienceFunctionalTestBase):
         nosetools.assert_raises(toolkit.Invalid, convert_package_name_or_id_to_title_or_name,
                                 'my-non-existent-id',
                                 context=context)
+
+
+class TestNameOrIdToIdConverter(ExperienceFunctionalTestBase):
+
+    def test_name_and_id_to_id(self):
+        '''
+        Package name and id both return the id.
+        '''
+        context = {'session': model.Session, 'model': model}
+        factories.Dataset(id='my-id', name='my-name')
+
+        nosetools.assert_equals(
+            'my-id', convert_package_name_or_id_to_id_for_type('my-name', context))
+        nosetools.assert_equals(
+            'my-id', convert_package_name_or_id_to_id_for_type('my-id', context))
+
+    def test_id_match_preferred_over_name_match(self):
+        '''
+        When one package's name is another package's id, the package with
+        that id is returned.
+        '''
+        context = {'session': model.Session, 'model': model}
+        factories.Dataset(id='my-id', name='my-name')
+        factories.Dataset(id='other-id', name='my-id')
+
+        result = convert_package_name_or_id_to_id_for_type('my-id', context)
+        nosetools.assert_equals('my-id', result)
+
+    def test_wrong_type_raises_invalid(self):
+        '''
+        A package of another type isn't found.
+        '''
+        context = {'session': model.Session, 'model': model}
+        factories.Dataset(id='my-id', name='my-name')
+
+        nosetools.assert_raises(toolkit.Invalid,
+                                convert_package_name_or_id_to_id_for_type,
+                                'my-name', context, package_type='experience')
+
+    def test_batch_lookup_fills_memo(self):
+        '''
+        Packages resolved in a batch are not looked up again by the single
+        converter with the same context.
+        '''
+        context = {'session': model.Session, 'model': model}
+        factories.Dataset(id='my-id', name='my-name')
+
+        packages = get_packages_for_names_or_ids(['my-name', 'bad-name'],
+                                                 context)
+        nosetools.assert_equals(packages.keys(), ['my-name'])
+        nosetools.assert_equals(
+            context['experience_package_id_memo'][('dataset', 'my-name')],
+            'my-id')
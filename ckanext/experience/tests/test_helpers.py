@@ -29,6 +29,7 @@ try:
 except ImportError:  # for ckan <= 2.3
     import ckan.new_tests.helpers as helpers
 
+from ckanext.experience import cache as experience_cache
 import ckanext.experience.logic.helpers as experience_helpers
 from ckanext.experience.tests import ExperienceFunctionalTestBase
 
@@ -88,3 +89,75 @@ class TestGetSiteStatistics(ExperienceFunctionalTestBase):
         stats = experience_helpers.get_site_statistics()
         nosetools.assert_equal(stats['dataset_count'], 10)
         nosetools.assert_equal(stats['experience_count'], 5)
+
+    def test_group_and_organization_count(self):
+        '''
+        Group and organization counts only include active groups and
+        organizations respectively.
+        '''
+        if not tk.check_ckan_version(min_version='2.5'):
+            raise SkipTest('get_site_statistics without user broken in CKAN 2.4')
+        sysadmin = factories.Sysadmin()
+        factories.Group()
+        factories.Group()
+        deleted_group = factories.Group()
+        factories.Organization()
+
+        helpers.call_action('group_delete', context={'user': sysadmin['name']},
+                            id=deleted_group['id'])
+
+        stats = experience_helpers.get_site_statistics()
+        nosetools.assert_equal(stats['group_count'], 2)
+        nosetools.assert_equal(stats['organization_count'], 1)
+
+    def test_site_statistics_cached_when_ttl_set(self):
+        '''
+        With a cache ttl, the stats aren't recalculated until the cache is
+        cleared.
+        '''
+        if not tk.check_ckan_version(min_version='2.5'):
+            raise SkipTest('get_site_statistics without user broken in CKAN 2.4')
+        experience_cache.site_stats.ttl = 60
+        try:
+            factories.Dataset(type='experience')
+            stats = experience_helpers.get_site_statistics()
+            nosetools.assert_equal(stats['experience_count'], 1)
+
+            factories.Dataset(type='experience')
+            stats = experience_helpers.get_site_statistics()
+            nosetools.assert_equal(stats['experience_count'], 1)
+
+            experience_cache.site_stats.clear()
+            stats = experience_helpers.get_site_statistics()
+            nosetools.assert_equal(stats['experience_count'], 2)
+        finally:
+            experience_cache.site_stats.ttl = 0
+            experience_cache.site_stats.clear()
+
+
+class TestExperienceImageSrcset(object):
+
+    def test_srcset_of_mime_type(self):
+        '''
+        The srcset lists the variants of the passed mime type with their
+        widths.
+        '''
+        package = {'image_variants': [
+            {'url': 'http://example.com/a-320w.webp', 'width': 320,
+             'type': 'image/webp'},
+            {'url': 'http://example.com/a-320w.jpg', 'width': 320,
+             'type': 'image/jpeg'},
+            {'url': 'http://example.com/a-640w.webp', 'width': 640,
+             'type': 'image/webp'}]}
+
+        nosetools.assert_equal(
+            experience_helpers.experience_image_srcset(package, 'image/webp'),
+            'http://example.com/a-320w.webp 320w, '
+            'http://example.com/a-640w.webp 640w')
+
+    def test_srcset_no_variants(self):
+        '''
+        The srcset is empty for experiences without resized images.
+        '''
+        nosetools.assert_equal(
+            experience_helpers.experience_image_srcset({}, 'image/jpeg'), '')
@@ -0,0 +1,141 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import tempfile
+
+from nose import tools as nosetools
+from nose import SkipTest
+
+try:
+    import ckan.tests.factories as factories
+except ImportError:  # for ckan <= 2.3
+    import ckan.new_tests.factories as factories
+
+from ckanext.experience import images as experience_images
+from ckanext.experience.tests import ExperienceFunctionalTestBase
+
+
+class FakeUpload(object):
+
+    '''An uploader that has stored its image, if any, in storage_path'''
+
+    def __init__(self, storage_path, filename=None):
+        self.storage_path = storage_path
+        self.filename = filename
+        self.filepath = filename and os.path.join(storage_path, filename)
+
+
+class TestMakeVariants(object):
+
+    def setup(self):
+        if experience_images.Image is None:
+            raise SkipTest('Pillow is not installed')
+        self.storage_path = tempfile.mkdtemp()
+        self.widths = experience_images.widths
+        experience_images.widths = (320, 640, 1280)
+
+    def teardown(self):
+        experience_images.widths = self.widths
+        shutil.rmtree(self.storage_path)
+
+    def test_make_variants(self):
+        '''
+        A JPEG copy, and a WebP one if Pillow supports it, is made for each
+        width narrower than the image, keeping its aspect ratio.
+        '''
+        filepath = os.path.join(self.storage_path, 'abc.png')
+        experience_images.Image.new('RGBA', (800, 400)).save(filepath, 'PNG')
+
+        variants = experience_images.make_variants(filepath)
+
+        jpeg_variants = [variant for variant in variants
+                         if variant['type'] == 'image/jpeg']
+        nosetools.assert_equal(
+            [(variant['width'], variant['filename'])
+             for variant in jpeg_variants],
+            [(320, 'abc-320w.jpg'), (640, 'abc-640w.jpg')])
+        for variant in variants:
+            nosetools.assert_true(variant['url'].endswith(
+                '/uploads/experience/' + variant['filename']))
+            image = experience_images.Image.open(
+                os.path.join(self.storage_path, variant['filename']))
+            nosetools.assert_equal(image.size,
+                                   (variant['width'], variant['width'] / 2))
+
+    def test_make_variants_not_an_image(self):
+        '''
+        A file that isn't an image gets no copies.
+        '''
+        filepath = os.path.join(self.storage_path, 'abc.png')
+        with open(filepath, 'w') as f:
+            f.write('not an image')
+
+        nosetools.assert_equal(experience_images.make_variants(filepath), [])
+
+
+class TestProcessUpload(ExperienceFunctionalTestBase):
+
+    def setup(self):
+        super(TestProcessUpload, self).setup()
+        self.storage_path = tempfile.mkdtemp()
+        self.old_variants = [{'url': 'http://example.com/old-320w.jpg',
+                              'width': 320, 'type': 'image/jpeg',
+                              'filename': 'old-320w.jpg'}]
+        with open(os.path.join(self.storage_path, 'old-320w.jpg'), 'w') as f:
+            f.write('old')
+
+    def teardown(self):
+        shutil.rmtree(self.storage_path)
+
+    def test_old_variants_kept_until_saved(self):
+        '''
+        When the image changes, the old copies are returned rather than
+        deleted, and removed by remove_unused_variants once no experience
+        uses the old image.
+        '''
+        upload = FakeUpload(self.storage_path)
+        data_dict = {'image_url': 'http://example.com/new.png'}
+
+        unused_variants = experience_images.process_upload(
+            upload, data_dict, old_image_url='old.png',
+            old_variants=self.old_variants)
+
+        nosetools.assert_equal(unused_variants, self.old_variants)
+        nosetools.assert_true('image_variants' not in data_dict)
+        nosetools.assert_true(os.path.exists(
+            os.path.join(self.storage_path, 'old-320w.jpg')))
+
+        experience_images.remove_unused_variants(upload, 'old.png',
+                                                 unused_variants)
+        nosetools.assert_false(os.path.exists(
+            os.path.join(self.storage_path, 'old-320w.jpg')))
+
+    def test_variants_of_image_in_use_kept(self):
+        '''
+        remove_unused_variants keeps the copies of an image another
+        experience uses.
+        '''
+        factories.Dataset(type='experience', image_url='old.png')
+        upload = FakeUpload(self.storage_path)
+
+        experience_images.remove_unused_variants(upload, 'old.png',
+                                                 self.old_variants)
+
+        nosetools.assert_true(os.path.exists(
+            os.path.join(self.storage_path, 'old-320w.jpg')))
@@ -31,8 +31,10 @@ try:
 except ImportError:  # for ckan <= 2.3
     import ckan.new_tests.helpers as helpers
 
+from ckanext.experience import plugin as experience_plugin
 from ckanext.experience.model import ExperiencePackageAssociation
-from ckanext.experience.tests import ExperienceFunctionalTestBase
+from ckanext.experience.tests import ExperienceFunctionalTestBase, \
+    count_queries
 
 import logging
 log = logging.getLogger(__name__)
@@ -70,6 +72,94 @@ class TestExperienceIndex(ExperienceFunctionalTestBase):
         response.mustcontain("my-experience")
 
 
+class TestExperienceIndexBenchmark(ExperienceFunctionalTestBase):
+
+    '''Query count benchmark for the Experience index page'''
+
+    # a full page of results, see ckan.datasets_per_page
+    num_experiences = 20
+
+    def _count_queries(self, app, url, **kwargs):
+        '''
+        GET url and return the number of database and Solr queries made.
+        '''
+        with count_queries() as counts:
+            app.get(url, status=200, **kwargs)
+        return counts
+
+    @helpers.change_config('ckanext.experience.index_notes_formatted', 'true')
+    def test_experience_index_queries_per_page(self):
+        '''
+        With the experience cards rendered from the search index, a full page
+        costs one Solr query and no more database queries than a page with a
+        single experience.
+        '''
+        app = self._get_test_app()
+        factories.Dataset(type='experience', notes='An *experience*')
+        # warm up per-process caches
+        app.get('/experience', status=200)
+
+        single = self._count_queries(app, '/experience')
+        for i in xrange(self.num_experiences - 1):
+            factories.Dataset(type='experience', notes='An *experience*')
+        full_page = self._count_queries(app, '/experience')
+
+        log.info('/experience: %d database queries for %d experiences, %d '
+                 'for 1', full_page['db'], self.num_experiences,
+                 single['db'])
+
+        nosetools.assert_equal(full_page['solr'], 1)
+        nosetools.assert_equal(full_page['db'], single['db'])
+
+    @helpers.change_config('ckanext.experience.index_notes_formatted', 'true')
+    def test_experience_index_queries_per_page_for_member(self):
+        '''
+        For an organization member, who can read its private datasets, a full
+        page costs one Solr query and no more database queries than a page
+        with a single experience either, and the counts include the private
+        datasets.
+        '''
+        app = self._get_test_app()
+        sysadmin = factories.Sysadmin()
+        member = factories.User()
+        org = factories.Organization(users=[{'name': member['name'],
+                                             'capacity': 'member'}])
+        extra_environ = {'REMOTE_USER': str(member['name'])}
+
+        def create_experience():
+            experience = factories.Dataset(type='experience',
+                                           notes='An *experience*')
+            dataset = factories.Dataset(owner_org=org['id'], private=True)
+            helpers.call_action(
+                'ckanext_experience_package_association_create',
+                context={'user': sysadmin['name']},
+                package_id=dataset['id'], experience_id=experience['id'])
+
+        create_experience()
+        # warm up per-process caches
+        app.get('/experience', status=200, extra_environ=extra_environ)
+
+        single = self._count_queries(app, '/experience',
+                                     extra_environ=extra_environ)
+        for i in xrange(self.num_experiences - 1):
+            create_experience()
+        full_page = self._count_queries(app, '/experience',
+                                        extra_environ=extra_environ)
+
+        log.info('/experience as a member: %d database queries for %d '
+                 'experiences, %d for 1', full_page['db'],
+                 self.num_experiences, single['db'])
+
+        nosetools.assert_equal(full_page['solr'], 1)
+        nosetools.assert_equal(full_page['db'], single['db'])
+
+        response = app.get('/experience', status=200,
+                           extra_environ=extra_environ)
+        nosetools.assert_equal(
+            response.body.count('<strong class="count">1 Dataset</strong>'),
+            self.num_experiences)
+
+
 class TestExperienceNewView(ExperienceFunctionalTestBase):
 
     def test_experience_create_form_renders(self):
@@ -241,6 +331,31 @@ class TestDatasetView(ExperienceFunctionalTestBase):
         nosetools.assert_true(experience_two['id'] in experience_added_options)
         nosetools.assert_true(experience_three['id'] in experience_added_options)
 
+    def test_dataset_experience_page_add_to_experience_dropdown_only_active(self):
+        '''
+        Add to experience dropdown doesn't list deleted experiences.
+        '''
+        app = self._get_test_app()
+        sysadmin = factories.Sysadmin()
+        dataset = factories.Dataset(name='my-dataset')
+        experience_one = factories.Dataset(name='my-first-experience', type='experience')
+        experience_two = factories.Dataset(name='my-second-experience', type='experience')
+
+        context = {'user': sysadmin['name']}
+        helpers.call_action('package_delete', context=context,
+                            id=experience_two['id'])
+
+        response = app.get(
+            url=url_for(controller='ckanext.experience.controller:ExperienceController',
+                        action='dataset_experience_list', id=dataset['id']),
+            extra_environ={'REMOTE_USER': str(sysadmin['name'])}
+        )
+
+        experience_add_form = response.forms['experience-add']
+        experience_added_options = [value for (value, _) in experience_add_form['experience_added'].options]
+        nosetools.assert_true(experience_one['id'] in experience_added_options)
+        nosetools.assert_true(experience_two['id'] not in experience_added_options)
+
     def test_dataset_experience_page_add_to_experience_dropdown_submit(self):
         '''
         Submitting 'Add to experience' form with selected experience value creates
@@ -396,3 +511,61 @@ class TestSearch(helpers.FunctionalTestBase):
         result = helpers.call_action('package_search', fq='tags:' + tag)
         nosetools.assert_equals(result['count'], 1)
 
+
+class TestBeforeSearchFilterCacheBenchmark(object):
+
+    '''
+    filterCache hit rate benchmark for the experience exclusion added by
+    `before_search`, against a stand-in for Solr's filterCache: a cache
+    entry per distinct filter query, as Solr keeps.
+    '''
+
+    # distinct user filter queries searched for
+    num_searches = 100
+
+    def _filter_queries(self, search_params):
+        '''
+        Return the filter queries Solr gets for search_params, as
+        PackageSearchQuery.run sends them.
+        '''
+        return [search_params.get('fq', '')] + \
+            list(search_params.get('fq_list', []))
+
+    def test_experience_exclusion_cached_across_searches(self):
+        '''
+        The exclusion is its own filter query, so after the first search it
+        is always found in the filterCache, however the user fq varies.
+        '''
+        if not experience_plugin.SEPARATE_FILTER_QUERIES:
+            raise SkipTest('fq_list is not supported by this CKAN version')
+
+        plugin = experience_plugin.ExperiencePlugin()
+        filter_cache = set()
+        lookups = hits = 0
+        for i in xrange(self.num_searches):
+            search_params = plugin.before_search(
+                {'fq': 'tags:"tag-{0}"'.format(i)})
+            for fq in self._filter_queries(search_params):
+                lookups += 1
+                if fq in filter_cache:
+                    hits += 1
+                filter_cache.add(fq)
+
+        log.info('filterCache: %d hits in %d lookups over %d searches',
+                 hits, lookups, self.num_searches)
+
+        # every exclusion but the first is a hit, no user fq is
+        nosetools.assert_equal(hits, self.num_searches - 1)
+        nosetools.assert_equal(len(filter_cache), self.num_searches + 1)
+
+    def test_filtered_by_experience_type_not_excluded(self):
+        '''
+        Searches already filtering on the experience type, in fq or fq_list,
+        get no exclusion.
+        '''
+        plugin = experience_plugin.ExperiencePlugin()
+
+        for search_params in ({'fq': '+dataset_type:experience'},
+                              {'fq_list': ['dataset_type:experience']}):
+            nosetools.assert_equal(
+                plugin.before_search(dict(search_params)), search_params)
@@ -0,0 +1,119 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import cgi
+import shutil
+import hashlib
+import tempfile
+from StringIO import StringIO
+
+from nose import tools as nosetools
+
+import ckan.plugins.toolkit as toolkit
+try:
+    import ckan.tests.factories as factories
+except ImportError:  # for ckan <= 2.3
+    import ckan.new_tests.factories as factories
+
+from ckanext.experience.upload import ExperienceUpload
+from ckanext.experience.tests import ExperienceFunctionalTestBase
+
+
+class FakeFileStorage(cgi.FieldStorage):
+
+    def __init__(self, fp, filename):
+        self.file = fp
+        self.filename = filename
+        self.name = 'image_upload'
+
+
+class TestExperienceUpload(ExperienceFunctionalTestBase):
+
+    def setup(self):
+        super(TestExperienceUpload, self).setup()
+        self.storage_path = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.storage_path)
+
+    def _upload(self, content, old_filename=None, max_size=2):
+        '''
+        Upload a file with content as an experience image replacing
+        old_filename, and return the image_url it's stored as.
+        '''
+        upload = ExperienceUpload('experience', old_filename)
+        upload.storage_path = self.storage_path
+        data_dict = {'image_url': '',
+                     'image_upload': FakeFileStorage(StringIO(content),
+                                                     'Image.PNG')}
+        upload.update_data_dict(data_dict, 'image_url', 'image_upload',
+                                'clear_upload')
+        upload.upload(max_size)
+        return data_dict['image_url']
+
+    def _stored(self, filename):
+        return os.path.exists(os.path.join(self.storage_path, filename))
+
+    def test_upload_stored_under_hash(self):
+        '''
+        An upload is stored under the SHA-1 hash of its content, and the same
+        content uploaded again is stored once.
+        '''
+        first = self._upload('image')
+        second = self._upload('image')
+
+        nosetools.assert_equal(first, hashlib.sha1('image').hexdigest() +
+                               '.png')
+        nosetools.assert_equal(second, first)
+        nosetools.assert_equal(os.listdir(self.storage_path), [first])
+
+    def test_upload_too_large(self):
+        '''
+        An upload larger than max_size MB raises a ValidationError and
+        leaves nothing behind.
+        '''
+        nosetools.assert_raises(toolkit.ValidationError, self._upload,
+                                'x' * (1024 * 1024 + 1), max_size=1)
+        nosetools.assert_equal(os.listdir(self.storage_path), [])
+
+    def test_replaced_image_kept_if_still_used(self):
+        '''
+        Replacing the image of one experience keeps the old file if another
+        experience uses it.
+        '''
+        old_filename = self._upload('old image')
+        factories.Dataset(type='experience', image_url=old_filename)
+        factories.Dataset(type='experience', image_url=old_filename)
+
+        new_filename = self._upload('new image', old_filename=old_filename)
+
+        nosetools.assert_true(self._stored(old_filename))
+        nosetools.assert_true(self._stored(new_filename))
+
+    def test_replaced_image_deleted_if_unused(self):
+        '''
+        Replacing the image of the only experience that uses it deletes the
+        old file.
+        '''
+        old_filename = self._upload('old image')
+        factories.Dataset(type='experience', image_url=old_filename)
+
+        new_filename = self._upload('new image', old_filename=old_filename)
+
+        nosetools.assert_false(self._stored(old_filename))
+        nosetools.assert_true(self._stored(new_filename))
@@ -0,0 +1,202 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import cgi
+import time
+import errno
+import hashlib
+import tempfile
+
+from sqlalchemy import func
+
+import ckan.lib.uploader as uploader
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+import logging
+log = logging.getLogger(__name__)
+
+# size of the chunks uploads are copied and hashed in
+CHUNK_SIZE = 2 ** 20
+
+# the types of uploaded files the default uploader accepts
+UPLOAD_TYPES = getattr(uploader, 'ALLOWED_UPLOAD_TYPES', (cgi.FieldStorage, ))
+
+# file extensions kept in the hashed filename
+EXTENSION_PATTERN = re.compile(r'^\.[a-z0-9]{1,10}$')
+
+
+def get_uploader(old_filename=None):
+    '''
+    Return the uploader for experience images: the one from an IUploader
+    plugin if there is one, otherwise an ExperienceUpload.
+    '''
+    # If get_uploader is available (introduced for IUploader in CKAN 2.5), use
+    # it, otherwise use the default uploader.
+    # https://github.com/ckan/ckan/pull/2510
+    try:
+        upload = uploader.get_uploader('experience', old_filename)
+    except AttributeError:
+        upload = uploader.Upload('experience', old_filename)
+
+    if type(upload) is uploader.Upload:
+        upload = ExperienceUpload('experience', old_filename)
+    return upload
+
+
+def count_image_references(filename):
+    '''
+    Return the number of experiences, in any state, whose image is the
+    uploaded file filename.
+    '''
+    return model.Session.query(func.count(model.PackageExtra.id)) \
+        .filter(model.PackageExtra.key == 'image_url') \
+        .filter(model.PackageExtra.value == filename) \
+        .filter(model.PackageExtra.state == 'active') \
+        .scalar()
+
+
+class ExperienceUpload(object):
+    '''
+    The uploader for experience images when no IUploader plugin provides one,
+    storing each image under the SHA-1 hash of its content, so an image
+    uploaded to many experiences is stored once.
+
+    The upload is copied to storage in chunks, hashing each chunk as it's
+    written, then moved to its hashed name unless a file of that name
+    already exists. The previous image is only deleted once no experience
+    uses it any more.
+
+    It has the same interface as CKAN's default uploader, but doesn't rely on
+    its internals.
+    '''
+
+    def __init__(self, object_type, old_filename=None):
+        self.storage_path = None
+        self.filename = None
+        self.filepath = None
+        self.old_filename = old_filename
+        self.upload_file = None
+
+        path = uploader.get_storage_path()
+        if not path:
+            return
+        self.storage_path = os.path.join(path, 'storage', 'uploads',
+                                         object_type)
+        try:
+            os.makedirs(self.storage_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def update_data_dict(self, data_dict, url_field, file_field, clear_field):
+        '''
+        Take the uploaded file out of data_dict, and keep the stored image's
+        filename in it if no file was uploaded. The hashed filename is only
+        known, and set, once the file has been uploaded.
+        '''
+        self.data_dict = data_dict
+        self.url_field = url_field
+        self.file_field = file_field
+        self.clear = data_dict.pop(clear_field, None)
+        url = data_dict.get(url_field, '')
+        field_storage = data_dict.pop(file_field, None)
+
+        if not self.storage_path:
+            return
+
+        if isinstance(field_storage, UPLOAD_TYPES):
+            self.filename = field_storage.filename
+            self.upload_file = getattr(field_storage, 'stream', None) or \
+                field_storage.file
+            data_dict[url_field] = self.filename
+        # keep the file if there has been no change
+        elif self.old_filename and not self.old_filename.startswith('http'):
+            if not self.clear:
+                data_dict[url_field] = self.old_filename
+            if self.clear and url == self.old_filename:
+                data_dict[url_field] = ''
+
+    def upload(self, max_size=2):
+        '''
+        Store the uploaded file, if there is one, and delete the previous
+        image if it was replaced or cleared and no other experience uses it.
+        max_size is the maximum size of the file in MB.
+        '''
+        if self.upload_file is not None:
+            self._upload_hashed(max_size)
+
+        if (self.clear and self.storage_path and self.old_filename
+                and not self.old_filename.startswith('http')
+                and self.old_filename != self.filename
+                and count_image_references(self.old_filename) <= 1):
+            # only the experience being updated uses it
+            try:
+                os.remove(os.path.join(self.storage_path, self.old_filename))
+            except OSError:
+                pass
+
+    def _upload_hashed(self, max_size):
+        start = time.time()
+        content_hash = hashlib.sha1()
+        size = 0
+
+        output_file = tempfile.NamedTemporaryFile(
+            dir=self.storage_path, suffix='~', delete=False)
+        try:
+            with output_file:
+                self.upload_file.seek(0)
+                while True:
+                    data = self.upload_file.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    size += len(data)
+                    if size > max_size * 1024 * 1024:
+                        raise toolkit.ValidationError(
+                            {self.file_field: ['File upload too large']})
+                    content_hash.update(data)
+                    output_file.write(data)
+        except Exception:
+            # don't let a failed clean up hide the error
+            try:
+                os.remove(output_file.name)
+            except OSError:
+                pass
+            raise
+        finally:
+            self.upload_file.close()
+
+        extension = os.path.splitext(self.filename)[1].lower()
+        if not EXTENSION_PATTERN.match(extension):
+            extension = ''
+        self.filename = content_hash.hexdigest() + extension
+        self.filepath = os.path.join(self.storage_path, self.filename)
+        self.data_dict[self.url_field] = self.filename
+
+        duplicate = os.path.exists(self.filepath)
+        if duplicate:
+            os.remove(output_file.name)
+        else:
+            os.rename(output_file.name, self.filepath)
+        self.clear = True
+
+        log.info('Stored experience image {0} ({1} bytes{2}) in {3:.1f}ms'
+                 .format(self.filename, size,
+                         ', already stored' if duplicate else '',
+                         (time.time() - start) * 1000))